@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Dict, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# (tokens mỗi giây, burst) cho từng action của /ai_credit_endpoint
+ACTION_RATE_LIMITS = {
+    "ask": (1.0, 5),
+    "swap": (0.2, 3),
+    "supply": (0.2, 3),
+    "fund_ai_wallet": (0.2, 3),
+    "buy_credits": (0.5, 5),
+    "confirm_buy_credits": (0.5, 5),
+}
+DEFAULT_RATE_LIMIT = (5.0, 20)
+
+# (số request đồng thời, số request chờ tối đa, thời gian chờ tối đa tính bằng giây) cho từng dependency
+DEPENDENCY_LIMITS = {
+    "llm": (8, 16, 10.0),
+    "kms": (4, 32, 15.0),
+    "bundler": (8, 32, 15.0),
+    "rpc": (16, 64, 15.0),
+}
+
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối do quá tải; retry_after là số giây client nên chờ."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> Tuple[bool, float]:
+        """Lấy một token; trả về (thành công, số giây đến khi có token tiếp theo)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    """Một request đang chờ slot; slot được trao trực tiếp khi có request khác release."""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self) -> None:
+        # Gọi khi đang giữ khóa của limiter
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class DependencyLimiter:
+    """Giới hạn số lệnh gọi đồng thời tới một dependency, với hàng đợi FIFO có giới hạn.
+
+    Khi hàng đợi đầy hoặc chờ quá `max_wait`, request bị từ chối ngay bằng AdmissionRejected
+    thay vì xếp hàng vô hạn và cùng timeout. Request chờ (thread hay coroutine) được `release`
+    đánh thức và nhận slot theo thứ tự đến.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        logger.warning(f"Rejected {self.name} call: {reason} (active={self.active}, waiting={self.waiting})")
+        return AdmissionRejected(f"{self.name} is overloaded, please retry later", retry_after=max(1.0, self.max_wait / 2))
+
+    def _enqueue(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> Optional[_Waiter]:
+        """Lấy slot ngay nếu còn trống và không ai chờ (trả về None), nếu không thì xếp hàng."""
+        with self._lock:
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject("queue full")
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Bỏ chờ; trả về True nếu slot đã được trao trước đó (người gọi đang giữ slot)."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def acquire(self) -> None:
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        waiter.event.wait(self.max_wait)
+        if not self._abandon(waiter):
+            raise self._reject("wait timeout")
+
+    async def acquire_async(self) -> None:
+        """Như acquire nhưng không chặn event loop khi chờ."""
+        waiter = self._enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                raise self._reject("wait timeout")
+        except asyncio.CancelledError:
+            if self._abandon(waiter):
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                # Trao slot cho request chờ lâu nhất, số slot đang dùng không đổi
+                self._waiters.popleft().grant()
+            else:
+                self.active -= 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AdmissionController:
+    """Rate limit theo (user, action) và giới hạn đồng thời theo dependency cho mỗi process."""
+
+    def __init__(self, action_limits: Optional[Dict] = None, dependency_limits: Optional[Dict] = None, max_buckets: int = 100000):
+        self.action_limits = action_limits or ACTION_RATE_LIMITS
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.dependencies = {
+            name: DependencyLimiter(name, *limits) for name, limits in (dependency_limits or DEPENDENCY_LIMITS).items()
+        }
+
+    def check_rate(self, user_id: str, action: str) -> None:
+        """Trừ một token của user cho action, raise AdmissionRejected nếu vượt giới hạn."""
+        key = (user_id, action)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(*self.action_limits.get(action, DEFAULT_RATE_LIMIT))
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            allowed, retry_after = bucket.try_acquire()
+        if not allowed:
+            raise AdmissionRejected(f"Rate limit exceeded for {action}", retry_after=retry_after)
+
+    def dependency(self, name: str) -> DependencyLimiter:
+        return self.dependencies[name]
+
+
+admission = AdmissionController()
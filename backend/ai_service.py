@@ -1,5 +1,5 @@
 from openai import OpenAI
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
+from anthropic import Anthropic
 from dotenv import load_dotenv
 import os
 import logging
@@ -7,12 +7,17 @@ import requests
 import re
 from auto_deposit import AutoDepositService
 from defi_service import DeFiService
+from conversation_service import ConversationStore
+from repositories import get_storage
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Prompt hệ thống cố định để provider cache được phần đầu prompt
+SYSTEM_PROMPT = "You are the assistant of an AI-powered DeFi app on Base. Answer concisely and use the earlier conversation for context."
+
 class AIService:
     def __init__(self):
         try:
@@ -41,19 +46,63 @@ class AIService:
 
         self.auto_deposit = AutoDepositService()
         self.defi_service = DeFiService()
+        # Lưu hội thoại vào conversations.db trừ khi tắt bằng PERSIST_CONVERSATIONS=false
+        persist = os.getenv("PERSIST_CONVERSATIONS", "true").lower() == "true"
+        self.conversations = ConversationStore(
+            get_storage().database("conversations.db", schema="conversations") if persist else None
+        )
+
+    def _enqueue_transfer_to_ai_wallet(self, user_id: str, amount: int) -> dict:
+        """Chuyển USDC từ ví user sang ví AI qua outbox."""
+        return self.auto_deposit.outbox.enqueue(user_id, "transfer_usdc_from_user", steps=[
+            {"action_type": "transfer", "amount": amount, "recipient": self.auto_deposit.ai_wallet_address}
+        ])
 
     def extract_amount(self, question: str) -> int:
         match = re.search(r'(\d+)', question)
         return int(match.group(1)) if match else 10
 
+    def _system_text(self, summary: str) -> str:
+        return f"{SYSTEM_PROMPT}\n\nSummary of earlier conversation:\n{summary}" if summary else SYSTEM_PROMPT
+
+    def _chat_messages(self, question: str, summary: str, history: list) -> list:
+        """Message cho OpenAI/DeepSeek: system và lịch sử đứng trước để prefix ổn định giữa các lượt (prefix caching)."""
+        return [{"role": "system", "content": self._system_text(summary)}] + history + [{"role": "user", "content": question}]
+
+    def _ask_anthropic(self, question: str, summary: str, history: list) -> str:
+        """Gọi Anthropic với cache_control trên system, bản tóm tắt và lượt cuối của lịch sử."""
+        system = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+        if summary:
+            system.append({"type": "text", "text": f"Summary of earlier conversation:\n{summary}", "cache_control": {"type": "ephemeral"}})
+        messages = [dict(message) for message in history] + [{"role": "user", "content": question}]
+        if history:
+            last = messages[len(history) - 1]
+            last["content"] = [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+        response = self.anthropic_client.beta.prompt_caching.messages.create(
+            model="claude-3-opus-20240229",
+            max_tokens=500,
+            system=system,
+            messages=messages
+        )
+        return response.content[0].text
+
     def ask_question(self, question: str, model: str = "anthropic", user_id: str = None) -> str:
         logger.info(f"Processing question: '{question}' with model: {model} for user: {user_id}")
-        
+        if model not in ("openai", "anthropic", "deepseek"):
+            raise ValueError(f"Unsupported model: {model}")
+
+        summary, history = self.conversations.build_context(user_id) if user_id else ("", [])
+        answer = self._answer(question, model, user_id, summary, history)
+        if user_id:
+            self.conversations.record(user_id, question, answer)
+        return answer
+
+    def _answer(self, question: str, model: str, user_id: str, summary: str, history: list) -> str:
         if model == "openai":
             try:
                 response = self.openai_client.chat.completions.create(
                     model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": question}],
+                    messages=self._chat_messages(question, summary, history),
                     max_tokens=500
                 )
                 return response.choices[0].message.content
@@ -62,12 +111,7 @@ class AIService:
 
         elif model == "anthropic":
             try:
-                response = self.anthropic_client.messages.create(
-                    model="claude-3-opus-20240229",
-                    max_tokens=500,
-                    messages=[{"role": "user", "content": f"{HUMAN_PROMPT}{question}{AI_PROMPT}"}]
-                )
-                return response.content[0].text
+                return self._ask_anthropic(question, summary, history)
             except Exception as e:
                 raise Exception(f"Anthropic error: {str(e)}")
 
@@ -81,27 +125,27 @@ class AIService:
                 amount = self.extract_amount(question)
 
                 if "deposit" in question_lower and "usdc" in question_lower:
-                    transfer_result = self.defi_service.transfer_usdc_from_user(user_id, amount)
-                    deposit_result = self.auto_deposit.deposit_usdc_to_uniswap(amount)
-                    return f"Deposited {amount} USDC to Uniswap pool. Tx hash: {deposit_result['tx_hash']}"
+                    transfer_job = self._enqueue_transfer_to_ai_wallet(user_id, amount)
+                    deposit_job = self.auto_deposit.deposit_usdc_to_uniswap(amount, user_id, transfer_job["job_id"])
+                    return f"Queued deposit of {amount} USDC to Uniswap pool. Job id: {deposit_job['job_id']}"
 
                 elif "swap" in question_lower and "usdc" in question_lower:
-                    transfer_result = self.defi_service.transfer_usdc_from_user(user_id, amount)
-                    swap_result = self.auto_deposit.deposit_usdc_to_uniswap(amount)
-                    return f"Swapped {amount} USDC to WETH. Tx hash: {swap_result['tx_hash']}"
+                    transfer_job = self._enqueue_transfer_to_ai_wallet(user_id, amount)
+                    swap_job = self.auto_deposit.deposit_usdc_to_uniswap(amount, user_id, transfer_job["job_id"])
+                    return f"Queued swap of {amount} USDC to WETH. Job id: {swap_job['job_id']}"
 
                 elif "transfer" in question_lower and "usdc" in question_lower:
-                    transfer_result = self.auto_deposit.transfer_usdc_to_user(amount, user_wallet)
-                    return f"Transferred {amount} USDC back to your wallet. Tx hash: {transfer_result['tx_hash']}"
+                    transfer_job = self.auto_deposit.transfer_usdc_to_user(amount, user_wallet, user_id)
+                    return f"Queued transfer of {amount} USDC back to your wallet. Job id: {transfer_job['job_id']}"
 
                 elif "withdraw" in question_lower and "usdc" in question_lower:
-                    withdraw_result = self.auto_deposit.withdraw_usdc_from_aave(amount, user_wallet)
-                    return f"Withdrawn {amount} USDC from Aave to your wallet. Tx hash: {withdraw_result['tx_hash']}"
+                    withdraw_job = self.auto_deposit.withdraw_usdc_from_aave(amount, user_wallet, user_id)
+                    return f"Queued withdrawal of {amount} USDC from Aave to your wallet. Job id: {withdraw_job['job_id']}"
 
                 headers = {"Authorization": f"Bearer {self.deepseek_api_key}", "Content-Type": "application/json"}
                 payload = {
                     "model": "deepseek-chat",
-                    "messages": [{"role": "user", "content": question}],
+                    "messages": self._chat_messages(question, summary, history),
                     "max_tokens": 500,
                     "temperature": 1.0
                 }
@@ -113,5 +157,3 @@ class AIService:
             except Exception as e:
                 raise Exception(f"DeepSeek error: {str(e)}")
 
-        else:
-            raise ValueError(f"Unsupported model: {model}")
@@ -1,5 +1,7 @@
 from defi_service import DeFiService
+from outbox_service import OutboxService, AI_AGENT_WALLET
 from dotenv import load_dotenv
+from typing import Optional
 import os
 import logging
 
@@ -9,71 +11,51 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class AutoDepositService:
+    """Các hành động từ ví AI agent, được đưa vào outbox và xử lý bởi worker nền."""
+
     def __init__(self):
         self.defi_service = DeFiService()
         self.ai_wallet_address = self.defi_service.ai_wallet_address
+        self.outbox = OutboxService(self.defi_service)
 
-    def deposit_usdc_to_uniswap(self, amount_usdc: int) -> dict:
-        try:
-            _, nonce = self.defi_service.get_wallet("AI_AGENT_WALLET")
-            approve_user_op = self.defi_service.create_user_op(self.ai_wallet_address, "approve", amount_usdc, nonce)
-            approve_result = self.defi_service.send_to_bundler(approve_user_op)
-            if "error" in approve_result:
-                raise Exception(approve_result["error"])
-            logger.info(f"Approved Uniswap to spend {amount_usdc} USDC: {approve_result.get('result')}")
-            self.defi_service.update_nonce("AI_AGENT_WALLET", nonce + 1)
-
-            nonce += 1
-            swap_user_op = self.defi_service.create_user_op(self.ai_wallet_address, "swap", amount_usdc, nonce)
-            swap_result = self.defi_service.send_to_bundler(swap_user_op)
-            if "error" in swap_result:
-                raise Exception(swap_result["error"])
-            logger.info(f"Swapped {amount_usdc} USDC to WETH: {swap_result.get('result')}")
-            self.defi_service.update_nonce("AI_AGENT_WALLET", nonce + 1)
+    def _enqueue(self, action: str, steps: list, user_id: Optional[str], depends_on: Optional[int]) -> dict:
+        job = self.outbox.enqueue(user_id or AI_AGENT_WALLET, action, steps, wallet_key=AI_AGENT_WALLET, depends_on=depends_on)
+        logger.info(f"Queued {action} from AI wallet as job {job['job_id']}")
+        return job
 
-            return {"tx_hash": swap_result.get("result", "pending"), "status": "success"}
+    def deposit_usdc_to_uniswap(self, amount_usdc: int, user_id: Optional[str] = None, depends_on: Optional[int] = None) -> dict:
+        try:
+            return self._enqueue("deposit_usdc_to_uniswap", [
+                {"action_type": "approve", "amount": amount_usdc},
+                {"action_type": "swap", "amount": amount_usdc}
+            ], user_id, depends_on)
         except Exception as e:
             logger.error(f"Failed to deposit USDC to Uniswap: {str(e)}")
             raise Exception(f"Deposit error: {str(e)}")
 
-    def supply_usdc_to_aave(self, amount_usdc: int) -> dict:
+    def supply_usdc_to_aave(self, amount_usdc: int, user_id: Optional[str] = None, depends_on: Optional[int] = None) -> dict:
         try:
-            _, nonce = self.defi_service.get_wallet("AI_AGENT_WALLET")
-            supply_user_op = self.defi_service.create_user_op(self.ai_wallet_address, "supply", amount_usdc, nonce)
-            supply_result = self.defi_service.send_to_bundler(supply_user_op)
-            if "error" in supply_result:
-                raise Exception(supply_result["error"])
-            logger.info(f"Supplied {amount_usdc} USDC to Aave: {supply_result.get('result')}")
-            self.defi_service.update_nonce("AI_AGENT_WALLET", nonce + 1)
-            return {"tx_hash": supply_result.get("result", "pending"), "status": "success"}
+            return self._enqueue("supply_usdc_to_aave", [
+                {"action_type": "supply", "amount": amount_usdc}
+            ], user_id, depends_on)
         except Exception as e:
             logger.error(f"Failed to supply USDC to Aave: {str(e)}")
             raise Exception(f"Supply error: {str(e)}")
 
-    def transfer_usdc_to_user(self, amount_usdc: int, recipient: str) -> dict:
+    def transfer_usdc_to_user(self, amount_usdc: int, recipient: str, user_id: Optional[str] = None, depends_on: Optional[int] = None) -> dict:
         try:
-            _, nonce = self.defi_service.get_wallet("AI_AGENT_WALLET")
-            transfer_user_op = self.defi_service.create_user_op(self.ai_wallet_address, "transfer", amount_usdc, nonce, recipient)
-            transfer_result = self.defi_service.send_to_bundler(transfer_user_op)
-            if "error" in transfer_result:
-                raise Exception(transfer_result["error"])
-            logger.info(f"Transferred {amount_usdc} USDC to {recipient}: {transfer_result.get('result')}")
-            self.defi_service.update_nonce("AI_AGENT_WALLET", nonce + 1)
-            return {"tx_hash": transfer_result.get("result", "pending"), "status": "success"}
+            return self._enqueue("transfer_usdc_to_user", [
+                {"action_type": "transfer", "amount": amount_usdc, "recipient": recipient}
+            ], user_id, depends_on)
         except Exception as e:
             logger.error(f"Failed to transfer USDC: {str(e)}")
             raise Exception(f"Transfer error: {str(e)}")
 
-    def withdraw_usdc_from_aave(self, amount_usdc: int, recipient: str) -> dict:
+    def withdraw_usdc_from_aave(self, amount_usdc: int, recipient: str, user_id: Optional[str] = None, depends_on: Optional[int] = None) -> dict:
         try:
-            _, nonce = self.defi_service.get_wallet("AI_AGENT_WALLET")
-            withdraw_user_op = self.defi_service.create_user_op(self.ai_wallet_address, "withdraw", amount_usdc, nonce, recipient)
-            withdraw_result = self.defi_service.send_to_bundler(withdraw_user_op)
-            if "error" in withdraw_result:
-                raise Exception(withdraw_result["error"])
-            logger.info(f"Withdrawn {amount_usdc} USDC from Aave to {recipient}: {withdraw_result.get('result')}")
-            self.defi_service.update_nonce("AI_AGENT_WALLET", nonce + 1)
-            return {"tx_hash": withdraw_result.get("result", "pending"), "status": "success"}
+            return self._enqueue("withdraw_usdc_from_aave", [
+                {"action_type": "withdraw", "amount": amount_usdc, "recipient": recipient}
+            ], user_id, depends_on)
         except Exception as e:
             logger.error(f"Failed to withdraw USDC from Aave: {str(e)}")
             raise Exception(f"Withdraw error: {str(e)}")
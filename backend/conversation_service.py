@@ -0,0 +1,176 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+from database import Database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Độ dài tối đa (ký tự) của mỗi lượt khi đưa vào bản tóm tắt
+SUMMARY_SNIPPET_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (~4 ký tự/token), đủ để giữ prompt trong ngân sách mà không cần tokenizer."""
+    return len(text) // 4 + 1
+
+
+def _snippet(text: str) -> str:
+    """Câu đầu tiên của một lượt, cắt ngắn, dùng cho bản tóm tắt trích xuất."""
+    first = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    return first if len(first) <= SUMMARY_SNIPPET_CHARS else first[:SUMMARY_SNIPPET_CHARS].rstrip() + "..."
+
+
+class Conversation:
+    def __init__(self, max_turns: int):
+        self.turns: deque = deque(maxlen=max_turns)  # (role, content)
+        self.summary = ""
+        self.version: Optional[int] = None  # turn_id lớn nhất trong DB lúc nạp; None là cần nạp lại
+
+
+class ConversationStore:
+    """Lịch sử hội thoại theo user cho ask_question, bộ nhớ có giới hạn.
+
+    Mỗi user có một ring buffer `max_turns` lượt; lượt cũ bị đẩy ra được gộp vào bản tóm tắt
+    trích xuất. Tối đa `max_users` hội thoại nằm trong bộ nhớ (LRU); nếu có `db` thì lượt và
+    bản tóm tắt được lưu để nạp lại sau khi bị evict hoặc khởi động lại. Khi có `db`, database là
+    nguồn chuẩn: bản trong LRU được so phiên bản (turn_id lớn nhất) mỗi lần dùng và nạp lại nếu
+    worker khác đã ghi hoặc xóa hội thoại.
+    """
+
+    def __init__(self, db: Optional[Database] = None, max_turns: int = 20, max_users: int = 10000,
+                 token_budget: int = 2000, summary_tokens: int = 300):
+        self.db = db
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _merge_summary(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        """Thêm các lượt vào bản tóm tắt, giữ phần mới nhất trong giới hạn summary_tokens."""
+        lines = [line for line in summary.split("\n") if line]
+        lines += [f"{'User' if role == 'user' else 'Assistant'}: {_snippet(content)}" for role, content in turns]
+        while lines and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def _version(self, user_id: str) -> int:
+        # turn_id tự tăng không tái sử dụng nên mọi lần ghi/xóa đều đổi giá trị này
+        return self.db.fetch_one(
+            "SELECT COALESCE(MAX(turn_id), 0) FROM conversation_turns WHERE user_id = ?", (user_id,)
+        )[0]
+
+    def _load(self, user_id: str) -> Conversation:
+        conversation = Conversation(self.max_turns)
+        if self.db:
+            conversation.version = self._version(user_id)
+            row = self.db.fetch_one("SELECT summary FROM conversation_summaries WHERE user_id = ?", (user_id,))
+            conversation.summary = row[0] if row else ""
+            rows = self.db.fetch_all(
+                "SELECT role, content FROM conversation_turns WHERE user_id = ? ORDER BY turn_id DESC LIMIT ?",
+                (user_id, self.max_turns)
+            )
+            conversation.turns.extend(reversed(rows))
+        return conversation
+
+    def _get(self, user_id: str) -> Conversation:
+        # Gọi khi đang giữ _lock
+        conversation = self._conversations.get(user_id)
+        if conversation is not None and self.db and conversation.version != self._version(user_id):
+            conversation = None
+        if conversation is None:
+            conversation = self._load(user_id)
+            self._conversations[user_id] = conversation
+        self._conversations.move_to_end(user_id)
+        if len(self._conversations) > self.max_users:
+            self._conversations.popitem(last=False)
+        return conversation
+
+    def build_context(self, user_id: str) -> Tuple[str, List[Dict[str, str]]]:
+        """Trả về (bản tóm tắt, các lượt gần nhất) vừa ngân sách token.
+
+        Lượt không vừa ngân sách được tóm tắt thay vì gửi nguyên văn; lượt được giữ theo cặp
+        user/assistant để danh sách message luôn bắt đầu bằng user.
+        """
+        with self._lock:
+            conversation = self._get(user_id)
+            turns = list(conversation.turns)
+            summary = conversation.summary
+
+        budget = self.token_budget - estimate_tokens(summary)
+        kept = len(turns)
+        used = 0
+        for i in range(len(turns) - 2, -1, -2):
+            pair_tokens = sum(estimate_tokens(content) for _, content in turns[i:i + 2])
+            if used + pair_tokens > budget:
+                break
+            used += pair_tokens
+            kept = i
+        if kept > 0:
+            summary = self._merge_summary(summary, turns[:kept])
+        return summary, [{"role": role, "content": content} for role, content in turns[kept:]]
+
+    def record(self, user_id: str, question: str, answer: str) -> None:
+        """Ghi một lượt hỏi-đáp; lượt bị đẩy khỏi ring buffer được gộp vào bản tóm tắt."""
+        new_turns = [("user", question), ("assistant", answer)]
+        with self._lock:
+            conversation = self._get(user_id)
+            overflow = max(0, len(conversation.turns) + len(new_turns) - self.max_turns)
+            evicted = list(conversation.turns)[:overflow]
+            if evicted:
+                conversation.summary = self._merge_summary(conversation.summary, evicted)
+            conversation.turns.extend(new_turns)
+            summary = conversation.summary
+            expected_version = conversation.version
+
+        if not self.db:
+            return
+        now = int(time.time())
+        version = None
+        try:
+            with self.db.transaction() as conn:
+                turn_ids = [conn.execute(
+                    "INSERT INTO conversation_turns (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, role, content, now)
+                ).lastrowid for role, content in new_turns]
+                # Bản trong bộ nhớ vẫn khớp DB nếu không worker nào ghi xen giữa và lượt mới nhất đã nạp còn đó
+                interleaved = conn.execute(
+                    "SELECT COUNT(*) FROM conversation_turns WHERE user_id = ? AND turn_id > ? AND turn_id < ?",
+                    (user_id, expected_version or 0, turn_ids[0])
+                ).fetchone()[0]
+                loaded = expected_version == 0 or conn.execute(
+                    "SELECT COUNT(*) FROM conversation_turns WHERE user_id = ? AND turn_id = ?", (user_id, expected_version)
+                ).fetchone()[0] == 1
+                if evicted:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO conversation_summaries (user_id, summary, updated_at) VALUES (?, ?, ?)",
+                        (user_id, summary, now)
+                    )
+                    # Chỉ giữ các lượt còn trong ring buffer
+                    conn.execute(
+                        """DELETE FROM conversation_turns WHERE user_id = ? AND turn_id NOT IN (
+                               SELECT turn_id FROM conversation_turns WHERE user_id = ? ORDER BY turn_id DESC LIMIT ?)""",
+                        (user_id, user_id, self.max_turns)
+                    )
+                if expected_version is not None and interleaved == 0 and loaded:
+                    version = turn_ids[-1]
+        except Exception as e:
+            logger.error(f"Failed to persist conversation for user {user_id}: {str(e)}")
+        with self._lock:
+            # version None: lần dùng sau nạp lại từ DB
+            conversation.version = version if conversation.version == expected_version else None
+
+    def clear(self, user_id: str) -> None:
+        with self._lock:
+            self._conversations.pop(user_id, None)
+        if self.db:
+            self.db.execute_batch([
+                ("DELETE FROM conversation_turns WHERE user_id = ?", (user_id,)),
+                ("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,)),
+            ])
@@ -1,4 +1,5 @@
-from database import Database
+from repositories import get_storage
+from event_service import event_bus
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -6,22 +7,20 @@ logger = logging.getLogger(__name__)
 
 class CreditService:
     def __init__(self):
-        self.db = Database("credits.db")
+        self.credits = get_storage().credits
 
     def check_credits(self, user_id: str) -> int:
-        result = self.db.fetch_one("SELECT credits FROM credits WHERE user_id = ?", (user_id,))
-        return result[0] if result else 0
+        return self.credits.get(user_id)
 
     def deduct_credits(self, user_id: str, model: str) -> bool:
         cost = {"openai": 1, "anthropic": 2, "deepseek": 1}.get(model, 1)
-        credits = self.check_credits(user_id)
-        if credits < cost:
+        if not self.credits.deduct(user_id, cost):
             return False
-        self.db.execute("INSERT OR REPLACE INTO credits (user_id, credits) VALUES (?, ?)", (user_id, credits - cost))
         logger.info(f"Deducted {cost} credits from {user_id} for model {model}")
+        event_bus.publish(user_id, "credits", {"credits_remaining": self.check_credits(user_id)})
         return True
 
     def add_credits(self, user_id: str, amount: int):
-        current_credits = self.check_credits(user_id)
-        self.db.execute("INSERT OR REPLACE INTO credits (user_id, credits) VALUES (?, ?)", (user_id, current_credits + amount))
+        self.credits.add(user_id, amount)
         logger.info(f"Added {amount} credits to {user_id}")
+        event_bus.publish(user_id, "credits", {"credits_remaining": self.check_credits(user_id)})
@@ -1,49 +1,231 @@
+import os
 import sqlite3
 import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Lược đồ theo tên; Database nhận tên lược đồ tường minh thay vì suy ra từ tên file
+SCHEMAS = {
+    "wallets": [
+        '''CREATE TABLE IF NOT EXISTS wallets (
+            user_id TEXT PRIMARY KEY,
+            wallet_address TEXT,
+            nonce INTEGER DEFAULT 0
+        )''',
+        # Bảng mới để theo dõi vị thế yield farming
+        '''CREATE TABLE IF NOT EXISTS positions (
+            position_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            platform TEXT,  -- "aave" hoặc "uniswap"
+            initial_amount REAL,  -- Số tiền ban đầu (USDC hoặc LP token)
+            initial_value_usd REAL,  -- Giá trị USD ban đầu
+            start_time INTEGER,  -- Timestamp bắt đầu
+            status TEXT DEFAULT 'active',  -- "active" hoặc "closed"
+            entry_index TEXT,  -- Liquidity index Aave (ray) lúc mở vị thế
+            entry_sqrt_price_x96 TEXT,  -- sqrtPriceX96 của pool Uniswap lúc mở vị thế
+            FOREIGN KEY (user_id) REFERENCES wallets(user_id)
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_positions_user_status ON positions (user_id, status)",
+        # Snapshot danh mục do sweep nền cập nhật, check_profits chỉ đọc
+        '''CREATE TABLE IF NOT EXISTS position_snapshots (
+            position_id INTEGER PRIMARY KEY,
+            user_id TEXT,
+            platform TEXT,
+            initial_value_usd REAL,
+            current_value_usd REAL,
+            profit_ratio REAL,
+            last_action TEXT,  -- "hold", "withdraw_queued", "withdrawn", "withdraw_failed"
+            updated_at INTEGER,
+            FOREIGN KEY (position_id) REFERENCES positions(position_id)
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_position_snapshots_user ON position_snapshots (user_id)",
+        # Outbox cho các hành động on-chain, worker nền xử lý theo thứ tự từng ví
+        '''CREATE TABLE IF NOT EXISTS outbox_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE,
+            user_id TEXT,  -- User nhận kết quả/event
+            wallet_key TEXT,  -- user_id của ví ký user operation
+            action TEXT,
+            payload TEXT,  -- JSON: steps, effects, on_failure
+            depends_on INTEGER,
+            status TEXT DEFAULT 'pending',  -- "pending", "running", "done", "failed"
+            step INTEGER DEFAULT 0,  -- Bước tiếp theo cần gửi
+            signed_op TEXT,  -- User operation đã ký của bước hiện tại (để gửi lại khi retry)
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            locked_until REAL,
+            result TEXT,  -- JSON: danh sách user operation hash
+            error TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_jobs_status ON outbox_jobs (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_jobs_wallet ON outbox_jobs (wallet_key, status)",
+        # Lease dùng chung giữa các instance (chia shard cho sweep)
+        '''CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )''',
+        # Kênh event chung giữa các process (xem EventBus.sync), dọn theo thời hạn lưu
+        '''CREATE TABLE IF NOT EXISTS events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            origin TEXT,  -- Process phát event, không tự giao lại
+            payload TEXT,  -- JSON event
+            created_at REAL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at)",
+        '''CREATE TABLE IF NOT EXISTS portfolio_totals (
+            user_id TEXT PRIMARY KEY,
+            position_count INTEGER,
+            total_initial_value_usd REAL,
+            total_current_value_usd REAL,
+            profit_ratio REAL,
+            updated_at INTEGER
+        )''',
+    ],
+    "credits": [
+        '''CREATE TABLE IF NOT EXISTS credits (
+            user_id TEXT PRIMARY KEY,
+            credits INTEGER DEFAULT 0
+        )''',
+    ],
+    "conversations": [
+        # Các lượt hội thoại gần nhất của user (ring buffer) và bản tóm tắt lượt cũ
+        '''CREATE TABLE IF NOT EXISTS conversation_turns (
+            turn_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            role TEXT,  -- "user" hoặc "assistant"
+            content TEXT,
+            created_at INTEGER
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_conversation_turns_user ON conversation_turns (user_id, turn_id)",
+        '''CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT,
+            updated_at INTEGER
+        )''',
+    ],
+}
+
+# Cột bổ sung cho database tạo trước khi có định giá on-chain
+MIGRATIONS = {
+    "wallets": [("positions", "entry_index", "TEXT"), ("positions", "entry_sqrt_price_x96", "TEXT")],
+}
+
+# Kết nối giữ sống cho database in-memory (shared cache), theo "<namespace>-<tên>"; SQLite xóa
+# database khi kết nối cuối đóng, nên `Database.close` bỏ kết nối này để giải phóng dữ liệu
+_memory_connections: Dict[str, Tuple[sqlite3.Connection, threading.RLock]] = {}
+_memory_lock = threading.Lock()
+
+
+def data_dir() -> str:
+    """Thư mục dữ liệu: DATA_DIR hoặc thư mục backend, không phụ thuộc thư mục làm việc."""
+    return os.getenv("DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
+
+
+def resolve_db_path(db_name: str) -> str:
+    return db_name if os.path.isabs(db_name) else os.path.join(data_dir(), db_name)
+
+
+def _memory_connection(name: str) -> Tuple[sqlite3.Connection, threading.RLock]:
+    with _memory_lock:
+        if name not in _memory_connections:
+            conn = sqlite3.connect(f"file:{name}?mode=memory&cache=shared", uri=True, check_same_thread=False)
+            _memory_connections[name] = (conn, threading.RLock())
+        return _memory_connections[name]
+
+
 class Database:
-    def __init__(self, db_name: str):
+    """Database SQLite với lược đồ tường minh.
+
+    backend "sqlite" dùng file (đường dẫn tương đối tính từ `data_dir()`); backend "memory" dùng
+    SQLite in-memory shared cache, dành cho test và benchmark: các instance cùng `namespace` và
+    tên trong process dùng chung một kết nối giữ sống (có khóa), namespace khác là database khác.
+    """
+
+    def __init__(self, db_name: str, schema: str, backend: str = "sqlite", namespace: str = ""):
+        if schema not in SCHEMAS:
+            raise ValueError(f"Unknown schema: {schema}")
+        if backend not in ("sqlite", "memory"):
+            raise ValueError(f"Unsupported database backend: {backend}")
         self.db_name = db_name
+        self.schema = schema
+        self.backend = backend
+        if backend == "sqlite":
+            self.path = resolve_db_path(db_name)
+        else:
+            name = os.path.splitext(os.path.basename(db_name))[0]
+            self.path = f"{namespace}-{name}" if namespace else name
         self.init_db()
 
+    @contextmanager
+    def _connect(self):
+        """Kết nối trong một transaction: commit khi thành công, rollback khi lỗi."""
+        if self.backend == "memory":
+            conn, lock = _memory_connection(self.path)
+            with lock, conn:
+                yield conn
+            return
+        # Chờ khóa thay vì lỗi ngay khi nhiều worker/process cùng ghi
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Kết nối trong một transaction cho chuỗi đọc/ghi phụ thuộc nhau: commit khi thành công, rollback khi lỗi.
+
+        Câu SELECT chỉ nằm trong transaction sau câu ghi đầu tiên (chế độ mặc định của sqlite3).
+        """
+        try:
+            with self._connect() as conn:
+                yield conn
+        except Exception as e:
+            logger.error(f"Database transaction error in {self.db_name}: {str(e)}")
+            raise
+
+    def close(self) -> None:
+        """Bỏ kết nối giữ sống của database in-memory (dữ liệu bị xóa); backend sqlite không giữ kết nối."""
+        if self.backend != "memory":
+            return
+        with _memory_lock:
+            entry = _memory_connections.pop(self.path, None)
+        if entry:
+            conn, lock = entry
+            with lock:
+                conn.close()
+
     def init_db(self):
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 c = conn.cursor()
-                if self.db_name == "wallets.db":
-                    c.execute('''CREATE TABLE IF NOT EXISTS wallets (
-                        user_id TEXT PRIMARY KEY,
-                        wallet_address TEXT,
-                        nonce INTEGER DEFAULT 0
-                    )''')
-                    # Bảng mới để theo dõi vị thế yield farming
-                    c.execute('''CREATE TABLE IF NOT EXISTS positions (
-                        position_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id TEXT,
-                        platform TEXT,  -- "aave" hoặc "uniswap"
-                        initial_amount REAL,  -- Số tiền ban đầu (USDC hoặc LP token)
-                        initial_value_usd REAL,  -- Giá trị USD ban đầu
-                        start_time INTEGER,  -- Timestamp bắt đầu
-                        status TEXT DEFAULT 'active',  -- "active" hoặc "closed"
-                        FOREIGN KEY (user_id) REFERENCES wallets(user_id)
-                    )''')
-                elif self.db_name == "credits.db":
-                    c.execute('''CREATE TABLE IF NOT EXISTS credits (
-                        user_id TEXT PRIMARY KEY,
-                        credits INTEGER DEFAULT 0
-                    )''')
+                if self.backend == "sqlite":
+                    # WAL cho phép đọc song song với ghi giữa các process
+                    c.execute("PRAGMA journal_mode=WAL")
+                for statement in SCHEMAS[self.schema]:
+                    c.execute(statement)
+                for table, column, column_type in MIGRATIONS.get(self.schema, []):
+                    columns = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+                    if column not in columns:
+                        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
                 conn.commit()
-                logger.info(f"Initialized database: {self.db_name}")
+                logger.info(f"Initialized database: {self.db_name} (schema={self.schema}, backend={self.backend})")
         except Exception as e:
             logger.error(f"Failed to initialize database {self.db_name}: {str(e)}")
             raise
 
     def execute(self, query: str, params: tuple = ()):
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 c = conn.cursor()
                 c.execute(query, params)
                 conn.commit()
@@ -52,9 +234,43 @@ class Database:
             logger.error(f"Database error in {self.db_name}: {str(e)}")
             raise
 
+    def update(self, query: str, params: tuple = ()) -> int:
+        """Thực thi UPDATE/DELETE và trả về số dòng bị ảnh hưởng."""
+        try:
+            with self._connect() as conn:
+                c = conn.cursor()
+                c.execute(query, params)
+                conn.commit()
+                return c.rowcount
+        except Exception as e:
+            logger.error(f"Database error in {self.db_name}: {str(e)}")
+            raise
+
+    def execute_batch(self, statements: list, guard: Optional[tuple] = None) -> bool:
+        """Thực thi nhiều câu lệnh (query, params) trong cùng một transaction.
+
+        Nếu có `guard` (câu UPDATE có điều kiện), nó chạy trước; khi không đúng một dòng bị ảnh
+        hưởng thì transaction bị rollback và trả về False.
+        """
+        try:
+            with self._connect() as conn:
+                c = conn.cursor()
+                if guard:
+                    c.execute(*guard)
+                    if c.rowcount != 1:
+                        conn.rollback()
+                        return False
+                for query, params in statements:
+                    c.execute(query, params)
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Database batch error in {self.db_name}: {str(e)}")
+            raise
+
     def fetch_one(self, query: str, params: tuple = ()):
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 c = conn.cursor()
                 c.execute(query, params)
                 return c.fetchone()
@@ -64,7 +280,7 @@ class Database:
 
     def fetch_all(self, query: str, params: tuple = ()):  # Thêm hàm fetch_all
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 c = conn.cursor()
                 c.execute(query, params)
                 return c.fetchall()
@@ -6,8 +6,12 @@ import os
 import json
 import requests
 import boto3
-from database import Database
+from repositories import get_storage
+from event_service import event_bus
+from gas_oracle import GasOracle
+from admission_service import admission
 import logging
+import asyncio
 from eth_account.messages import encode_defunct
 import time
 from typing import Dict, Tuple, Optional
@@ -16,6 +20,13 @@ import aiohttp  # Thêm để tối ưu hóa HTTP requests bất đồng bộ
 
 load_dotenv()
 
+# Giới hạn mỗi request tới bundler, thấp hơn nhiều so với lease của job outbox (120 giây)
+BUNDLER_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# Theo dõi receipt: chu kỳ poll, thời gian theo dõi tối đa và số hash trong một JSON-RPC batch
+RECEIPT_POLL_SECONDS = 3
+RECEIPT_TIMEOUT_SECONDS = 180
+RECEIPT_BATCH_SIZE = 50
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -28,7 +39,13 @@ class DeFiService:
         
         self.w3 = self._initialize_web3(max_retries)
         self._setup_contracts_and_addresses()
-        self.db = Database("wallets.db")
+        self.storage = get_storage()
+        # Database SQL của outbox, snapshot và lease
+        self.db = self.storage.db
+        self.gas_oracle = GasOracle(self.w3, self.bundler_url, self.entry_point)
+        # user_op_hash -> (user_id, hạn theo dõi); một task poller dùng chung hỏi receipt theo batch
+        self._pending_receipts: Dict[str, Tuple[str, float]] = {}
+        self._receipt_poller: Optional[asyncio.Task] = None
         self.ai_agent_address = Web3.to_checksum_address(self.w3.eth.account.from_key(os.getenv("AI_AGENT_PRIVATE_KEY")).address)
         self.ai_wallet_address = self.create_ai_wallet()
 
@@ -77,6 +94,9 @@ class DeFiService:
         self.wallet_abi = json.loads('''[
             {"inputs":[{"internalType":"address","name":"dest","type":"address"},{"internalType":"uint256","name":"value","type":"uint256"},{"internalType":"bytes","name":"func","type":"bytes"}],"name":"execute","outputs":[],"stateMutability":"nonpayable","type":"function"}
         ]''')
+        self.entry_point_abi = json.loads('''[
+            {"inputs":[{"internalType":"address","name":"sender","type":"address"},{"internalType":"uint192","name":"key","type":"uint192"}],"name":"getNonce","outputs":[{"internalType":"uint256","name":"nonce","type":"uint256"}],"stateMutability":"view","type":"function"}
+        ]''')
         self.usdc_abi = json.loads('''[
             {"constant":false,"inputs":[{"name":"_to","type":"address"},{"name":"_value","type":"uint256"}],"name":"transfer","outputs":[{"name":"","type":"bool"}],"type":"function"},
             {"constant":false,"inputs":[{"name":"spender","type":"address"},{"name":"amount","type":"uint256"}],"name":"approve","outputs":[{"name":"","type":"bool"}],"type":"function"}
@@ -84,13 +104,12 @@ class DeFiService:
 
     def get_wallet(self, user_id: str) -> Tuple[Optional[str], int]:
         """Lấy địa chỉ ví và nonce từ database."""
-        result = self.db.fetch_one("SELECT wallet_address, nonce FROM wallets WHERE user_id = ?", (user_id,))
+        result = self.storage.wallets.get(user_id)
         return result if result else (None, 0)
 
     def save_wallet(self, user_id: str, wallet_address: str) -> None:
         """Lưu ví vào database."""
-        self.db.execute("INSERT OR REPLACE INTO wallets (user_id, wallet_address, nonce) VALUES (?, ?, ?)", 
-                       (user_id, Web3.to_checksum_address(wallet_address), 0))
+        self.storage.wallets.save(user_id, Web3.to_checksum_address(wallet_address))
 
     async def create_aa_wallet(self, user_id: str) -> str:
         """Tạo hoặc lấy ví AA cho user_id bất đồng bộ."""
@@ -106,12 +125,13 @@ class DeFiService:
         code = self.w3.eth.get_code(predicted_address)
 
         if code == b'\x00':
+            max_fee, priority_fee = self.gas_oracle.get_fees()
             tx = factory_contract.functions.createAccount(owner, salt).build_transaction({
                 'from': self.ai_agent_address,
                 'nonce': await self._get_nonce_async(self.ai_agent_address),
                 'gas': 200000,
-                'maxFeePerGas': self.w3.to_wei('2', 'gwei'),
-                'maxPriorityFeePerGas': self.w3.to_wei('1', 'gwei')
+                'maxFeePerGas': max_fee,
+                'maxPriorityFeePerGas': priority_fee
             })
             signed_tx = self.w3.eth.account.sign_transaction(tx, os.getenv("AI_AGENT_PRIVATE_KEY"))
             tx_hash = await self._send_raw_transaction_async(signed_tx.raw_transaction)
@@ -138,45 +158,20 @@ class DeFiService:
         """Chờ receipt bất đồng bộ."""
         return self.w3.eth.wait_for_transaction_receipt(tx_hash)
 
-    async def fund_ai_wallet(self, user_id: str, amount_eth: float) -> Dict[str, str]:
-        """Chuyển ETH từ ví user sang ví AI bất đồng bộ."""
-        user_wallet, nonce = self.get_wallet(user_id)
-        if not user_wallet:
-            raise ValueError("User AA Wallet not found")
-        
-        amount_wei = self.w3.to_wei(amount_eth, 'ether')
-        user_op = self._create_basic_user_op(user_wallet, nonce)
-        user_op.update({"callData": "0x", "value": amount_wei, "to": self.ai_wallet_address})
-        
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-        logger.info(f"Funded AI Wallet with {amount_eth} ETH from {user_id}: {result.get('result')}")
-        return {"tx_hash": result.get("result", "pending"), "status": "success"}
-
-    async def transfer_usdc_from_user(self, user_id: str, amount_usdc: int) -> Dict[str, str]:
-        """Chuyển USDC từ ví user sang ví AI bất đồng bộ."""
-        user_wallet, nonce = self.get_wallet(user_id)
-        if not user_wallet:
-            raise ValueError("User AA Wallet not found")
-        
-        user_op = self.create_user_op(user_wallet, "transfer", amount_usdc, nonce, self.ai_wallet_address)
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-        logger.info(f"Transferred {amount_usdc} USDC from {user_id} to AI Wallet: {result.get('result')}")
-        return {"tx_hash": result.get("result", "pending"), "status": "success"}
-
-    def _create_basic_user_op(self, wallet_address: str, nonce: int) -> Dict:
-        """Tạo user operation cơ bản."""
-        return {
+    def _create_basic_user_op(self, wallet_address: str, nonce: int, action_type: str = "basic", call_data: str = "0x") -> Dict:
+        """Tạo user operation cơ bản với phí và gas limit lấy từ gas oracle."""
+        max_fee, priority_fee = self.gas_oracle.get_fees()
+        user_op = {
             "sender": Web3.to_checksum_address(wallet_address),
             "nonce": nonce,
             "initCode": "0x",
-            "callData": "0x",
-            "callGasLimit": 200000,
-            "verificationGasLimit": 100000,
-            "preVerificationGas": 21000,
-            "maxFeePerGas": self.w3.to_wei("2", 'gwei'),
-            "maxPriorityFeePerGas": self.w3.to_wei('1', 'gwei'),
+            "callData": call_data,
+            "maxFeePerGas": max_fee,
+            "maxPriorityFeePerGas": priority_fee,
             "signature": "0x",
         }
+        user_op.update(self.gas_oracle.get_gas_limits(action_type, user_op))
+        return user_op
 
     def create_user_op(self, wallet_address: str, action_type: str, amount: int, nonce: int, recipient: str = None) -> Dict:
         """Tạo user operation cho các hành động khác nhau."""
@@ -207,143 +202,90 @@ class DeFiService:
         else:
             raise ValueError(f"Unsupported action_type: {action_type}")
 
-        user_op = self._create_basic_user_op(wallet_address, nonce)
-        user_op["callData"] = call_data
-        return user_op
+        return self._create_basic_user_op(wallet_address, nonce, action_type, call_data)
 
-    async def _sign_and_send_user_op_async(self, user_op: Dict, user_id: str, nonce: int) -> Dict:
-        """Ký và gửi user operation bất đồng bộ."""
+    def sign_user_op(self, user_op: Dict) -> Dict:
+        """Ký user operation bằng KMS."""
         user_op_hash = self.w3.keccak(text=str(user_op))
         message = encode_defunct(hexstr=user_op_hash.hex())
-        signature = self.kms_client.sign(
-            KeyId=self.kms_key_id,
-            Message=message.body,
-            MessageType='DIGEST',
-            SigningAlgorithm='ECDSA_SHA_256'
-        )['Signature']
+        with admission.dependency("kms").slot():
+            signature = self.kms_client.sign(
+                KeyId=self.kms_key_id,
+                Message=message.body,
+                MessageType='DIGEST',
+                SigningAlgorithm='ECDSA_SHA_256'
+            )['Signature']
         user_op["signature"] = '0x' + signature.hex()
+        return user_op
 
-        async with aiohttp.ClientSession() as session:
+    async def send_user_op_async(self, user_op: Dict, user_id: str) -> Dict:
+        """Gửi user operation đã ký tới bundler (không cập nhật nonce)."""
+        nonce = user_op["nonce"]
+        async with admission.dependency("bundler").slot_async(), aiohttp.ClientSession(timeout=BUNDLER_TIMEOUT) as session:
             async with session.post(self.bundler_url, json={"jsonrpc": "2.0", "method": "eth_sendUserOperation", 
                                                             "params": [user_op, self.entry_point], "id": 1}) as response:
                 result = await response.json()
                 if "error" in result:
+                    event_bus.publish(user_id, "user_op", {"status": "failed", "nonce": nonce, "error": str(result["error"])})
                     raise Exception(result["error"])
-                self.update_nonce(user_id, nonce + 1)
+                user_op_hash = result.get("result")
+                event_bus.publish(user_id, "user_op", {"status": "submitted", "nonce": nonce, "user_op_hash": user_op_hash})
+                if user_op_hash:
+                    self._track_user_op(user_id, user_op_hash)
                 return result
 
-    def update_nonce(self, user_id: str, new_nonce: int) -> None:
-        """Cập nhật nonce trong database."""
-        self.db.execute("UPDATE wallets SET nonce = ? WHERE user_id = ?", (new_nonce, user_id))
-
-    async def swap_usdc_to_eth(self, amount_in: int, user_id: str) -> Dict[str, str]:
-        """Swap USDC sang ETH trên Uniswap bất đồng bộ."""
-        wallet_address, nonce = self.get_wallet(user_id)
-        if not wallet_address:
-            raise ValueError("AA wallet not found for user")
-        
-        approve_op = self.create_user_op(wallet_address, "approve", amount_in, nonce, self.uniswap_router)
-        await self._sign_and_send_user_op_async(approve_op, user_id, nonce)
-
-        nonce += 1
-        user_op = self.create_user_op(wallet_address, "swap", amount_in, nonce)
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-
-        initial_value_usd = amount_in
-        self.db.execute(
-            "INSERT INTO positions (user_id, platform, initial_amount, initial_value_usd, start_time) VALUES (?, ?, ?, ?, ?)",
-            (user_id, "uniswap", amount_in, initial_value_usd, int(time.time()))
-        )
-        return {"tx_hash": result.get("result", "pending")}
-
-    async def supply_usdc(self, amount: int, user_id: str) -> Dict[str, str]:
-        """Cung cấp USDC cho Aave bất đồng bộ."""
-        wallet_address, nonce = self.get_wallet(user_id)
-        if not wallet_address:
-            raise ValueError("AA wallet not found for user")
-        
-        user_op = self.create_user_op(wallet_address, "supply", amount, nonce)
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-
-        initial_value_usd = amount
-        self.db.execute(
-            "INSERT INTO positions (user_id, platform, initial_amount, initial_value_usd, start_time) VALUES (?, ?, ?, ?, ?)",
-            (user_id, "aave", amount, initial_value_usd, int(time.time()))
-        )
-        return {"tx_hash": result.get("result", "pending")}
-
-    def get_aave_position_value(self, user_id: str, position_id: int) -> float:
-        """Tính giá trị vị thế Aave."""
-        position = self.db.fetch_one(
-            "SELECT initial_amount FROM positions WHERE position_id = ? AND user_id = ? AND platform = 'aave'",
-            (position_id, user_id)
-        )
-        if not position:
-            raise ValueError("Position not found")
-        initial_amount = position[0]
-
-        apy = 0.05  # Giả định 5% APY
-        current_time = int(time.time())
-        start_time = self.db.fetch_one("SELECT start_time FROM positions WHERE position_id = ?", (position_id,))[0]
-        time_elapsed_years = (current_time - start_time) / (365 * 24 * 3600)
-        return initial_amount * (1 + apy * time_elapsed_years)
-
-    def get_uniswap_position_value(self, user_id: str, position_id: int) -> float:
-        """Tính giá trị vị thế Uniswap."""
-        position = self.db.fetch_one(
-            "SELECT initial_amount FROM positions WHERE position_id = ? AND user_id = ? AND platform = 'uniswap'",
-            (position_id, user_id)
-        )
-        if not position:
-            raise ValueError("Position not found")
-        initial_amount = position[0]
-
-        fee_earned = initial_amount * 0.003  # Giả định phí 0.3%
-        return initial_amount + fee_earned
-
-    async def check_and_withdraw(self, user_id: str) -> None:
-        """Kiểm tra và rút vốn nếu đạt ngưỡng bất đồng bộ."""
-        wallet_address, _ = self.get_wallet(user_id)
-        if not wallet_address:
-            raise ValueError("AA wallet not found for user")
-
-        positions = self.db.fetch_all(
-            "SELECT position_id, platform, initial_value_usd FROM positions WHERE user_id = ? AND status = 'active'",
-            (user_id,)
-        )
-        
-        for position_id, platform, initial_value_usd in positions:
-            current_value = (self.get_aave_position_value if platform == "aave" else self.get_uniswap_position_value)(user_id, position_id)
-            profit_ratio = current_value / initial_value_usd
-            
-            if profit_ratio >= 1.05 or profit_ratio <= 0.99:
-                nonce = self.get_wallet(user_id)[1]
-                action_type = "withdraw" if platform == "aave" else "transfer"
-                user_op = self.create_user_op(wallet_address, action_type, int(initial_value_usd), nonce, wallet_address)
-                
-                try:
-                    result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-                    logger.info(f"Withdrawn {platform} position {position_id} for {user_id}. Profit ratio: {profit_ratio}")
-                except Exception as e:
-                    logger.error(f"Failed to withdraw {platform} position {position_id}: {str(e)}")
-                    continue
-
-    async def transfer_usdc(self, amount: int, user_id: str, recipient: str) -> Dict[str, str]:
-        """Chuyển USDC từ ví user sang địa chỉ khác bất đồng bộ."""
-        wallet_address, nonce = self.get_wallet(user_id)
-        if not wallet_address:
-            raise ValueError("AA wallet not found for user")
-        
-        user_op = self.create_user_op(wallet_address, "transfer", amount, nonce, recipient)
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-        return {"tx_hash": result.get("result", "pending")}
-
-    async def withdraw_usdc(self, amount: int, user_id: str, recipient: str) -> Dict[str, str]:
-        """Rút USDC từ Aave về ví khác bất đồng bộ."""
-        wallet_address, nonce = self.get_wallet(user_id)
-        if not wallet_address:
-            raise ValueError("AA wallet not found for user")
-        
-        user_op = self.create_user_op(wallet_address, "withdraw", amount, nonce, recipient)
-        result = await self._sign_and_send_user_op_async(user_op, user_id, nonce)
-        return {"tx_hash": result.get("result", "pending")}
\ No newline at end of file
+    def get_onchain_nonce(self, wallet_address: str) -> int:
+        """Đọc nonce của ví AA từ EntryPoint (key 0)."""
+        entry_point_contract = self.w3.eth.contract(address=self.entry_point, abi=self.entry_point_abi)
+        return entry_point_contract.functions.getNonce(Web3.to_checksum_address(wallet_address), 0).call()
+
+    def _track_user_op(self, user_id: str, user_op_hash: str) -> None:
+        """Đưa user operation vào poller receipt dùng chung (gọi trong event loop)."""
+        self._pending_receipts[user_op_hash] = (user_id, time.time() + RECEIPT_TIMEOUT_SECONDS)
+        if self._receipt_poller is None or self._receipt_poller.done():
+            self._receipt_poller = asyncio.create_task(self._poll_receipts_async())
+
+    async def _poll_receipts_async(self) -> None:
+        """Hỏi receipt của mọi user operation đang chờ theo JSON-RPC batch, trong giới hạn bundler.
+
+        Số request tới bundler theo số batch mỗi chu kỳ, không theo số user operation; task dừng
+        khi không còn gì để theo dõi.
+        """
+        async with aiohttp.ClientSession(timeout=BUNDLER_TIMEOUT) as session:
+            while True:
+                await asyncio.sleep(RECEIPT_POLL_SECONDS)
+                now = time.time()
+                for user_op_hash, (_, deadline) in list(self._pending_receipts.items()):
+                    if deadline < now:
+                        logger.warning(f"Stopped tracking user operation {user_op_hash}: no receipt after {RECEIPT_TIMEOUT_SECONDS}s")
+                        self._pending_receipts.pop(user_op_hash, None)
+                hashes = list(self._pending_receipts)
+                if not hashes:
+                    # Bỏ tham chiếu trước khi đóng session để hash mới thêm vào khởi động poller mới
+                    self._receipt_poller = None
+                    return
+                for i in range(0, len(hashes), RECEIPT_BATCH_SIZE):
+                    try:
+                        await self._fetch_receipts_async(session, hashes[i:i + RECEIPT_BATCH_SIZE])
+                    except Exception as e:
+                        # Lỗi hay quá tải: thử lại ở chu kỳ sau
+                        logger.error(f"Failed to fetch user operation receipts: {str(e)}")
+
+    async def _fetch_receipts_async(self, session: aiohttp.ClientSession, hashes: list) -> None:
+        batch = [{"jsonrpc": "2.0", "method": "eth_getUserOperationReceipt", "params": [user_op_hash], "id": i}
+                 for i, user_op_hash in enumerate(hashes)]
+        async with admission.dependency("bundler").slot_async():
+            async with session.post(self.bundler_url, json=batch) as response:
+                results = await response.json()
+        if not isinstance(results, list):
+            raise Exception(f"Unexpected batch response: {results}")
+        for item in results:
+            receipt = item.get("result")
+            if not receipt or not isinstance(item.get("id"), int) or item["id"] >= len(hashes):
+                continue
+            user_op_hash = hashes[item["id"]]
+            tracked = self._pending_receipts.pop(user_op_hash, None)
+            if tracked:
+                status = "confirmed" if receipt.get("success") else "failed"
+                tx_hash = receipt.get("receipt", {}).get("transactionHash")
+                event_bus.publish(tracked[0], "user_op", {"status": status, "user_op_hash": user_op_hash, "tx_hash": tx_hash})
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from database import Database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Các loại event có thể gộp (coalesce): chỉ giá trị mới nhất có ý nghĩa với client
+COALESCED_EVENT_TYPES = {"credits", "position_value"}
+
+
+class Subscription:
+    """Hàng đợi event có giới hạn cho một client (WebSocket/SSE).
+
+    Event cùng khóa coalesce được ghi đè tại chỗ, event còn lại xếp hàng theo thứ tự.
+    Khi đầy, event cũ nhất bị bỏ và client nhận được số event bị mất (backpressure).
+    """
+
+    def __init__(self, user_id: str, loop: asyncio.AbstractEventLoop, max_pending: int = 100):
+        self.user_id = user_id
+        self.loop = loop
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+        self._seq = itertools.count()
+
+    def push(self, event: Dict) -> None:
+        """Thêm event (an toàn khi gọi từ thread khác, ví dụ scheduler)."""
+        key = event.get("coalesce_key") or f"seq:{next(self._seq)}"
+        with self._lock:
+            if key in self._pending:
+                self._pending.pop(key)
+            elif len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[key] = event
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def next_batch(self, timeout: Optional[float] = None) -> List[Dict]:
+        """Chờ và lấy toàn bộ event đang chờ; trả về [] nếu hết timeout."""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        with self._lock:
+            self._ready.clear()
+            batch = list(self._pending.values())
+            self._pending.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            batch.insert(0, {"type": "events_dropped", "user_id": self.user_id, "count": dropped, "ts": time.time()})
+        return batch
+
+
+class EventBus:
+    """Phát event theo user tới các client đang subscribe.
+
+    Event được giao ngay cho client của process này. Sau `attach(db)`, event còn được ghi vào
+    bảng `events` và relay (`run_relay`) của mỗi process đọc event do process khác ghi, nên
+    client kết nối tới worker nào cũng nhận được event phát từ sweep hay outbox ở worker khác.
+    """
+
+    def __init__(self, max_pending: int = 100, retention_seconds: float = 300):
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.origin = uuid.uuid4().hex
+        self.db: Optional[Database] = None
+        self._subscribers: Dict[str, List[Subscription]] = {}
+        self._outgoing: List[Dict] = []
+        self._last_event_id = 0
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+
+    def attach(self, db: Database) -> None:
+        """Dùng bảng `events` của db làm kênh chung giữa các process; chỉ nhận event mới từ lúc này."""
+        last_event_id = self._max_event_id(db)
+        with self._lock:
+            self.db = db
+            self._last_event_id = last_event_id
+        logger.info(f"Event bus attached to {db.db_name} (origin {self.origin[:8]})")
+
+    @staticmethod
+    def _max_event_id(db: Database) -> int:
+        return db.fetch_one("SELECT COALESCE(MAX(event_id), 0) FROM events")[0]
+
+    def subscribe(self, user_id: str) -> Subscription:
+        """Đăng ký nhận event của user (gọi trong event loop của FastAPI)."""
+        subscription = Subscription(user_id, asyncio.get_running_loop(), self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append(subscription)
+        logger.info(f"Subscribed to events for {user_id}")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscribers.pop(subscription.user_id, None)
+        logger.info(f"Unsubscribed from events for {subscription.user_id}")
+
+    def publish(self, user_id: str, event_type: str, data: Dict, coalesce_key: Optional[str] = None) -> None:
+        """Phát event cho user; không bao giờ raise để không ảnh hưởng luồng chính.
+
+        Event cho process khác được gom lại và ghi vào `events` ở lượt relay kế tiếp.
+        """
+        try:
+            if coalesce_key is None and event_type in COALESCED_EVENT_TYPES:
+                coalesce_key = event_type
+            event = {"type": event_type, "user_id": user_id, "data": data, "ts": time.time()}
+            if coalesce_key:
+                event["coalesce_key"] = coalesce_key
+            with self._lock:
+                subscriptions = list(self._subscribers.get(user_id, []))
+                if self.db is not None:
+                    self._outgoing.append(event)
+            for subscription in subscriptions:
+                subscription.push(event)
+        except Exception as e:
+            logger.error(f"Failed to publish {event_type} event for {user_id}: {str(e)}")
+
+    def sync(self) -> None:
+        """Một lượt relay: ghi event đang chờ, giao event mới của process khác cho client ở đây."""
+        with self._lock:
+            db, outgoing, self._outgoing = self.db, self._outgoing, []
+            user_ids = list(self._subscribers)
+        if db is None:
+            return
+        now = time.time()
+        statements = [(
+            "INSERT INTO events (user_id, origin, payload, created_at) VALUES (?, ?, ?, ?)",
+            (event["user_id"], self.origin, json.dumps(event, default=str), event["ts"])
+        ) for event in outgoing]
+        if now - self._last_prune >= self.retention_seconds:
+            statements.append(("DELETE FROM events WHERE created_at < ?", (now - self.retention_seconds,)))
+            self._last_prune = now
+        if statements:
+            db.execute_batch(statements)
+
+        # Mọi event có id <= max_id đã commit, event commit sau luôn có id lớn hơn
+        max_id = self._max_event_id(db)
+        if user_ids and max_id > self._last_event_id:
+            placeholders = ", ".join("?" for _ in user_ids)
+            rows = db.fetch_all(
+                f"""SELECT payload FROM events WHERE event_id > ? AND event_id <= ? AND origin != ?
+                    AND user_id IN ({placeholders}) ORDER BY event_id""",
+                (self._last_event_id, max_id, self.origin, *user_ids)
+            )
+            for payload, in rows:
+                event = json.loads(payload)
+                with self._lock:
+                    subscriptions = list(self._subscribers.get(event["user_id"], []))
+                for subscription in subscriptions:
+                    subscription.push(event)
+        self._last_event_id = max_id
+
+    async def run_relay(self, poll_seconds: float = 1.0) -> None:
+        """Chạy relay trong event loop cho tới khi bị hủy."""
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as e:
+                logger.error(f"Event relay error: {str(e)}")
+            await asyncio.sleep(poll_seconds)
+
+
+def format_event(event: Dict) -> str:
+    """Serialize event cho client (bỏ khóa nội bộ)."""
+    return json.dumps({k: v for k, v in event.items() if k != "coalesce_key"}, default=str)
+
+
+event_bus = EventBus()
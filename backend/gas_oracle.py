@@ -0,0 +1,160 @@
+import logging
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import requests
+from web3 import Web3
+
+from admission_service import admission
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Giá trị mặc định khi chưa có ước tính (giữ nguyên các giá trị cũ)
+DEFAULT_GAS_LIMITS = {"callGasLimit": 200000, "verificationGasLimit": 100000, "preVerificationGas": 21000}
+DEFAULT_MAX_FEE_GWEI = 2
+DEFAULT_PRIORITY_FEE_GWEI = 1
+
+# Chữ ký giả 65 byte để bundler mô phỏng khi ước tính gas
+DUMMY_SIGNATURE = "0x" + "ff" * 64 + "1c"
+
+ENTRY_POINT_NONCE_ABI = [{"inputs": [{"name": "sender", "type": "address"}, {"name": "key", "type": "uint192"}],
+                          "name": "getNonce", "outputs": [{"name": "nonce", "type": "uint256"}],
+                          "stateMutability": "view", "type": "function"}]
+
+
+def _to_int(value) -> int:
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+class GasOracle:
+    """Cache phí và gas limit cho user operation, được làm mới trong nền.
+
+    `get_fees` và `get_gas_limits` chỉ đọc cache nên không thêm RPC nào vào request path;
+    `refresh` (chạy bởi scheduler) gọi `eth_feeHistory` và `eth_estimateUserOperationGas`.
+    Cache giữ giá trị tốt gần nhất; giá trị mặc định chỉ dùng khi chưa ước tính được lần nào.
+    Giá trị quá TTL (làm mới liên tục thất bại) vẫn được dùng nhưng nhân thêm biên an toàn,
+    tăng theo số TTL đã quá (tối đa `max_stale_multiplier`), và có cảnh báo trong log.
+    """
+
+    def __init__(self, w3: Web3, bundler_url: str, entry_point: str, fee_ttl: float = 36, estimate_ttl: float = 120,
+                 history_blocks: int = 10, reward_percentile: int = 50, base_fee_multiplier: float = 2.0,
+                 gas_margin: float = 1.2, max_shapes: int = 256, stale_fee_margin: float = 1.5,
+                 stale_gas_margin: float = 1.25, max_stale_multiplier: float = 4.0):
+        self.w3 = w3
+        self.bundler_url = bundler_url
+        self.entry_point = entry_point
+        self.fee_ttl = fee_ttl  # Ba chu kỳ làm mới 12 giây của scheduler
+        self.estimate_ttl = estimate_ttl
+        self.history_blocks = history_blocks
+        self.reward_percentile = reward_percentile
+        self.base_fee_multiplier = base_fee_multiplier
+        self.gas_margin = gas_margin
+        self.max_shapes = max_shapes
+        self.stale_fee_margin = stale_fee_margin
+        self.stale_gas_margin = stale_gas_margin
+        self.max_stale_multiplier = max_stale_multiplier
+        self._lock = threading.Lock()
+        self._stale_warned: Dict[str, float] = {}
+        self._fees: Optional[Tuple[int, int, float]] = None
+        self._estimates: Dict[Tuple, Tuple[Dict, float]] = {}
+        self._samples: Dict[Tuple, Dict] = {}
+
+    @staticmethod
+    def shape_key(action_type: str, call_data: str) -> Tuple:
+        """Khóa cache: loại hành động, function selector và độ dài calldata."""
+        return (action_type, call_data[:10], len(call_data))
+
+    def _stale_multiplier(self, kind: str, age: float, ttl: float, margin: float) -> float:
+        """Hệ số an toàn cho giá trị cache đã `age` giây; 1 nếu còn trong TTL."""
+        if age <= ttl:
+            return 1.0
+        multiplier = min(margin ** math.ceil(age / ttl - 1), self.max_stale_multiplier)
+        now = time.time()
+        with self._lock:
+            # Cảnh báo tối đa một lần mỗi TTL cho mỗi loại giá trị
+            should_warn = now - self._stale_warned.get(kind, 0) >= ttl
+            if should_warn:
+                self._stale_warned[kind] = now
+        if should_warn:
+            logger.warning(f"Gas oracle {kind} are {age:.0f}s old (ttl {ttl}s), applying x{multiplier:.2f} safety margin")
+        return multiplier
+
+    def get_fees(self) -> Tuple[int, int]:
+        """Trả về (maxFeePerGas, maxPriorityFeePerGas) gần nhất, hoặc giá trị mặc định khi chưa có.
+
+        Phí quá `fee_ttl` được nâng maxFeePerGas theo biên an toàn để op không bị định giá thấp
+        khi base fee tăng mà không làm mới được.
+        """
+        with self._lock:
+            fees = self._fees
+        if not fees:
+            return self.w3.to_wei(DEFAULT_MAX_FEE_GWEI, 'gwei'), self.w3.to_wei(DEFAULT_PRIORITY_FEE_GWEI, 'gwei')
+        max_fee, priority_fee, updated_at = fees
+        multiplier = self._stale_multiplier("fees", time.time() - updated_at, self.fee_ttl, self.stale_fee_margin)
+        return int(max_fee * multiplier), priority_fee
+
+    def get_gas_limits(self, action_type: str, user_op: Dict) -> Dict[str, int]:
+        """Trả về gas limit đã ước tính cho dạng calldata này; lần đầu dùng mặc định và ghi mẫu để ước tính nền."""
+        key = self.shape_key(action_type, user_op["callData"])
+        with self._lock:
+            cached = self._estimates.get(key)
+            if key not in self._samples and len(self._samples) < self.max_shapes:
+                # Nonce và phí của mẫu được làm mới ở mỗi lần ước tính, op này sẽ dùng hết nonce hiện tại
+                self._samples[key] = {name: user_op[name] for name in ("sender", "initCode", "callData")}
+        if not cached:
+            return dict(DEFAULT_GAS_LIMITS)
+        estimate, updated_at = cached
+        multiplier = self._stale_multiplier("gas estimates", time.time() - updated_at, self.estimate_ttl, self.stale_gas_margin)
+        return {name: int(value * multiplier) for name, value in estimate.items()}
+
+    def refresh(self) -> None:
+        """Làm mới phí và ước tính gas (gọi bởi scheduler)."""
+        try:
+            self.refresh_fees()
+        except Exception as e:
+            logger.error(f"Failed to refresh fee history: {str(e)}")
+        self.refresh_estimates()
+
+    def refresh_fees(self) -> None:
+        with admission.dependency("rpc").slot():
+            history = self.w3.eth.fee_history(self.history_blocks, "latest", [self.reward_percentile])
+        # Phần tử cuối của baseFeePerGas là base fee dự kiến của block kế tiếp
+        next_base_fee = history["baseFeePerGas"][-1]
+        rewards = sorted(block_rewards[0] for block_rewards in history["reward"] if block_rewards)
+        priority_fee = rewards[len(rewards) // 2] if rewards else self.w3.to_wei(DEFAULT_PRIORITY_FEE_GWEI, 'gwei')
+        max_fee = int(next_base_fee * self.base_fee_multiplier) + priority_fee
+        with self._lock:
+            self._fees = (max_fee, priority_fee, time.time())
+        logger.info(f"Gas oracle fees updated: maxFeePerGas={max_fee}, maxPriorityFeePerGas={priority_fee}")
+
+    def refresh_estimates(self) -> None:
+        with self._lock:
+            now = time.time()
+            samples = [(key, user_op) for key, user_op in self._samples.items()
+                       if key not in self._estimates or now - self._estimates[key][1] >= self.estimate_ttl / 2]
+        max_fee, priority_fee = self.get_fees()
+        entry_point_contract = self.w3.eth.contract(address=self.entry_point, abi=ENTRY_POINT_NONCE_ABI)
+        for key, sample in samples:
+            try:
+                with admission.dependency("rpc").slot():
+                    nonce = entry_point_contract.functions.getNonce(sample["sender"], 0).call()
+                user_op = dict(sample, nonce=nonce, maxFeePerGas=max_fee, maxPriorityFeePerGas=priority_fee,
+                               signature=DUMMY_SIGNATURE, **DEFAULT_GAS_LIMITS)
+                with admission.dependency("bundler").slot():
+                    response = requests.post(self.bundler_url, json={
+                        "jsonrpc": "2.0", "method": "eth_estimateUserOperationGas", "params": [user_op, self.entry_point], "id": 1
+                    }, timeout=10)
+                result = response.json()
+                if "error" in result:
+                    raise Exception(result["error"])
+                estimate = {
+                    name: int(_to_int(result["result"][name]) * self.gas_margin)
+                    for name in ("callGasLimit", "verificationGasLimit", "preVerificationGas")
+                }
+                with self._lock:
+                    self._estimates[key] = (estimate, time.time())
+            except Exception as e:
+                logger.error(f"Failed to estimate gas for {key[0]} ({key[1]}): {str(e)}")
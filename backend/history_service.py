@@ -0,0 +1,271 @@
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lease_service import shard_for
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PLATFORMS = ["aave", "uniswap"]
+DAY_SECONDS = 24 * 3600
+HOUR_SECONDS = 3600
+
+
+class HistoryStore:
+    """Lưu mẫu giá trị vị thế theo thời gian dưới dạng batch cột (mảng numpy có kiểu, nén npz).
+
+    - `raw/<ngày>/<shard>/`: mẫu gốc từ mỗi lượt sweep, mỗi lần flush là một segment; `compact`
+      gộp các segment của ngày đã kết thúc thành một.
+    - `1h/<ngày>/<shard>/`: rollup theo giờ cho mỗi vị thế (giá trị cuối, min/max profit ratio).
+    Shard theo hash của user_id nên truy vấn của một user chỉ đọc shard của user đó; thư mục ngày
+    và tên file (chứa khoảng timestamp) giới hạn các segment cần đọc theo khoảng thời gian.
+    """
+
+    def __init__(self, root_dir: str = "history", raw_retention_days: int = 7, rollup_retention_days: int = 365,
+                 flush_rows: int = 50000, num_shards: int = 16):
+        self.root_dir = root_dir
+        self.raw_retention_days = raw_retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.flush_rows = flush_rows
+        self.num_shards = num_shards
+        self._buffer: List[Tuple] = []
+        self._lock = threading.Lock()
+
+    def append(self, ts: int, user_id: str, position_id: int, platform: str, value_usd: float, profit_ratio: float) -> None:
+        with self._lock:
+            self._buffer.append((ts, user_id, position_id, PLATFORMS.index(platform), value_usd, profit_ratio))
+            should_flush = len(self._buffer) >= self.flush_rows
+        if should_flush:
+            self.flush()
+
+    @staticmethod
+    def _frame(rows: List[Tuple]) -> pd.DataFrame:
+        """Chuyển các mẫu trong buffer thành batch cột có kiểu."""
+        ts, user_ids, position_ids, platforms, values, ratios = zip(*rows)
+        return pd.DataFrame({
+            "ts": np.asarray(ts, dtype=np.int64),
+            "user_id": np.asarray(user_ids, dtype=str),
+            "position_id": np.asarray(position_ids, dtype=np.int64),
+            "platform": np.asarray(platforms, dtype=np.uint8),
+            "value_usd": np.asarray(values, dtype=np.float64),
+            "profit_ratio": np.asarray(ratios, dtype=np.float64),
+        })
+
+    def flush(self) -> None:
+        """Ghi buffer thành một segment cột cho mỗi ngày có mẫu."""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        frame = self._frame(rows)
+        for (day, shard), part in frame.groupby([frame["ts"] // DAY_SECONDS, self._shards(frame)]):
+            self._write_segment(self._partition("raw", day, shard), part)
+        logger.info(f"Flushed {len(rows)} position samples to history")
+
+    def _shards(self, frame: pd.DataFrame) -> pd.Series:
+        shards = {user_id: shard_for(user_id, self.num_shards) for user_id in frame["user_id"].unique()}
+        return frame["user_id"].map(shards).rename("shard")
+
+    def _partition(self, tier: str, day: int, shard: int) -> str:
+        return os.path.join(self.root_dir, tier, str(day), str(shard))
+
+    def _write_segment(self, directory: str, frame: pd.DataFrame) -> None:
+        os.makedirs(directory, exist_ok=True)
+        name = f"{frame['ts'].min()}-{frame['ts'].max()}-{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(directory, name + ".tmp.npz")
+        columns = {}
+        for column in frame.columns:
+            values = frame[column].to_numpy()
+            # Cột chuỗi được lưu dạng unicode cố định để np.load không cần pickle
+            columns[column] = values.astype(str) if values.dtype == object else values
+        np.savez_compressed(tmp_path, **columns)
+        os.replace(tmp_path, os.path.join(directory, name + ".npz"))
+
+    @staticmethod
+    def _segment_range(path: str) -> Tuple[int, int]:
+        start, end, _ = os.path.basename(path)[:-len(".npz")].split("-")
+        return int(start), int(end)
+
+    @staticmethod
+    def _files(directory: str) -> List[str]:
+        return sorted(p for p in glob.glob(os.path.join(directory, "*.npz")) if not p.endswith(".tmp.npz"))
+
+    def _segments(self, tier: str, start: Optional[int], end: Optional[int], user_id: Optional[str] = None) -> List[str]:
+        """Segment của tier giao với [start, end], chỉ trong shard của user_id nếu có."""
+        shard = str(shard_for(user_id, self.num_shards)) if user_id is not None else "*"
+        selected = []
+        for day_dir in glob.glob(os.path.join(self.root_dir, tier, "*")):
+            day = int(os.path.basename(day_dir))
+            if (start is not None and day < start // DAY_SECONDS) or (end is not None and day > end // DAY_SECONDS):
+                continue
+            # Segment nằm ngay trong thư mục ngày là dữ liệu trước khi chia shard (chứa mọi user)
+            paths = self._files(day_dir) + glob.glob(os.path.join(day_dir, shard, "*.npz"))
+            for path in paths:
+                if path.endswith(".tmp.npz"):
+                    continue
+                seg_start, seg_end = self._segment_range(path)
+                if (start is None or seg_end >= start) and (end is None or seg_start <= end):
+                    selected.append(path)
+        return sorted(selected)
+
+    @staticmethod
+    def _load(paths: Sequence[str]) -> pd.DataFrame:
+        frames = []
+        for path in paths:
+            with np.load(path) as data:
+                frames.append(pd.DataFrame({column: data[column] for column in data.files}))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def query(self, user_id: Optional[str] = None, position_id: Optional[int] = None, start: Optional[int] = None,
+              end: Optional[int] = None, resolution: str = "raw") -> pd.DataFrame:
+        """Lấy mẫu trong khoảng [start, end] theo user/vị thế, sắp xếp theo thời gian.
+
+        Dữ liệu raw gồm cả mẫu còn trong buffer (đọc bản sao, không flush từ luồng đọc).
+        """
+        if resolution not in ("raw", "1h"):
+            raise ValueError(f"Unsupported resolution: {resolution}")
+        frame = self._load(self._segments(resolution, start, end, user_id))
+        if resolution == "raw":
+            with self._lock:
+                rows = list(self._buffer)
+            if rows:
+                buffered = self._frame(rows)
+                frame = buffered if frame.empty else pd.concat([frame, buffered], ignore_index=True)
+        if frame.empty:
+            return frame
+        mask = np.ones(len(frame), dtype=bool)
+        if user_id is not None:
+            mask &= frame["user_id"].to_numpy() == user_id
+        if position_id is not None:
+            mask &= frame["position_id"].to_numpy() == position_id
+        if start is not None:
+            mask &= frame["ts"].to_numpy() >= start
+        if end is not None:
+            mask &= frame["ts"].to_numpy() <= end
+        # Trong lúc compact thay segment, mẫu có thể nằm ở cả bản cũ và bản mới
+        frame = frame[mask].drop_duplicates(["position_id", "ts"], keep="last")
+        frame = frame.sort_values(["position_id", "ts"], kind="stable").reset_index(drop=True)
+        frame["platform"] = pd.Categorical.from_codes(frame["platform"].astype(np.int8), PLATFORMS)
+        return frame
+
+    def compact(self) -> None:
+        """Gộp segment raw và tạo rollup theo giờ cho các ngày đã kết thúc, xóa dữ liệu quá hạn.
+
+        Rollup được tạo lại khi shard có segment raw mới hơn (mẫu đến trễ), nên raw chỉ bị
+        xóa khi mọi mẫu đã nằm trong rollup.
+        """
+        today = int(time.time()) // DAY_SECONDS
+        for tier in ("1h", "raw"):
+            for day_dir in glob.glob(os.path.join(self.root_dir, tier, "*")):
+                if int(os.path.basename(day_dir)) < today:
+                    self._partition_legacy(tier, day_dir)
+        for day_dir in glob.glob(os.path.join(self.root_dir, "raw", "*")):
+            day = int(os.path.basename(day_dir))
+            if day >= today:
+                continue
+            for shard_dir in glob.glob(os.path.join(day_dir, "*")):
+                raw_segments = self._files(shard_dir)
+                if not raw_segments:
+                    shutil.rmtree(shard_dir)
+                    continue
+                if len(raw_segments) > 1:
+                    # Ngày đã kết thúc: một segment cho mỗi shard để truy vấn chỉ mở một file
+                    merged = self._load(raw_segments).sort_values(["position_id", "ts"], kind="stable")
+                    self._replace_segments(shard_dir, merged, raw_segments)
+                    raw_segments = self._files(shard_dir)
+                rollup_dir = os.path.join(self.root_dir, "1h", str(day), os.path.basename(shard_dir))
+                rollup_segments = self._files(rollup_dir)
+                if not rollup_segments or self._newest_mtime(raw_segments) > self._newest_mtime(rollup_segments):
+                    self._replace_segments(rollup_dir, self._rollup(self._load(raw_segments), HOUR_SECONDS), rollup_segments)
+            if not os.listdir(day_dir) or day < today - self.raw_retention_days:
+                shutil.rmtree(day_dir)
+        for day_dir in glob.glob(os.path.join(self.root_dir, "1h", "*")):
+            if int(os.path.basename(day_dir)) < today - self.rollup_retention_days:
+                shutil.rmtree(day_dir)
+
+    def _replace_segments(self, directory: str, frame: pd.DataFrame, old_paths: Sequence[str]) -> None:
+        # Ghi bản mới trước rồi mới xóa bản cũ để truy vấn luôn thấy dữ liệu
+        self._write_segment(directory, frame)
+        for path in old_paths:
+            os.remove(path)
+
+    def _partition_legacy(self, tier: str, day_dir: str) -> None:
+        """Chia segment tạo trước khi có shard (nằm ngay trong thư mục ngày) vào các shard."""
+        legacy = self._files(day_dir)
+        if not legacy:
+            return
+        frame = self._load(legacy)
+        day = int(os.path.basename(day_dir))
+        for shard, part in frame.groupby(self._shards(frame)):
+            self._write_segment(self._partition(tier, day, shard), part)
+        for path in legacy:
+            os.remove(path)
+
+    @staticmethod
+    def _newest_mtime(paths: Sequence[str]) -> int:
+        return max(os.stat(path).st_mtime_ns for path in paths)
+
+    @staticmethod
+    def _rollup(frame: pd.DataFrame, bucket_seconds: int) -> pd.DataFrame:
+        frame = frame.sort_values("ts", kind="stable").assign(bucket=frame["ts"] // bucket_seconds * bucket_seconds)
+        grouped = frame.groupby(["position_id", "bucket"], sort=False)
+        rolled = grouped.agg(
+            user_id=("user_id", "last"),
+            platform=("platform", "last"),
+            value_usd=("value_usd", "last"),
+            profit_ratio=("profit_ratio", "last"),
+            ratio_min=("profit_ratio", "min"),
+            ratio_max=("profit_ratio", "max"),
+        ).reset_index().rename(columns={"bucket": "ts"})
+        return rolled.astype({"ts": np.int64, "position_id": np.int64, "platform": np.uint8})
+
+    def backtest(self, thresholds: Sequence[Tuple[float, float]], user_id: Optional[str] = None,
+                 start: Optional[int] = None, end: Optional[int] = None) -> List[Dict]:
+        """Mô phỏng ngưỡng (chốt lời, cắt lỗ) trên lịch sử profit ratio, vector hóa trên mọi vị thế.
+
+        Vị thế thoát ở mẫu đầu tiên chạm ngưỡng, nếu không thì tính theo mẫu cuối cùng.
+        Lịch sử dừng khi vị thế bị rút theo ngưỡng đang dùng, nên ngưỡng rộng hơn chỉ được
+        đánh giá trên phần dữ liệu đã có.
+        """
+        frame = self.query(user_id=user_id, start=start, end=end)
+        if frame.empty or not thresholds:
+            return []
+
+        ratios = frame["profit_ratio"].to_numpy()
+        ts = frame["ts"].to_numpy()
+        position_ids = frame["position_id"].to_numpy()
+        group_starts = np.flatnonzero(np.r_[True, position_ids[1:] != position_ids[:-1]])
+        group_ends = np.r_[group_starts[1:], len(frame)] - 1
+
+        take_profit = np.array([t[0] for t in thresholds], dtype=np.float64)
+        stop_loss = np.array([t[1] for t in thresholds], dtype=np.float64)
+        hits = (ratios[:, None] >= take_profit[None, :]) | (ratios[:, None] <= stop_loss[None, :])
+        row_index = np.where(hits, np.arange(len(frame))[:, None], len(frame))
+        first_hit = np.minimum.reduceat(row_index, group_starts, axis=0)
+        triggered = first_hit < len(frame)
+        exit_rows = np.where(triggered, first_hit, group_ends[:, None])
+        exit_ratios = ratios[exit_rows]
+        holding_hours = (ts[exit_rows] - ts[group_starts][:, None]) / HOUR_SECONDS
+
+        results = []
+        for i, (tp, sl) in enumerate(thresholds):
+            results.append({
+                "take_profit": tp,
+                "stop_loss": sl,
+                "positions": int(len(group_starts)),
+                "take_profit_exits": int((exit_ratios[:, i] >= tp)[triggered[:, i]].sum()),
+                "stop_loss_exits": int((exit_ratios[:, i] <= sl)[triggered[:, i]].sum()),
+                "still_open": int((~triggered[:, i]).sum()),
+                "mean_exit_ratio": float(exit_ratios[:, i].mean()),
+                "mean_holding_hours": float(holding_hours[:, i].mean()),
+            })
+        return results
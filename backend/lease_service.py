@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import List, Set
+
+from database import Database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LeaseStore(ABC):
+    """Giao diện lưu lease có thời hạn; cài đặt cho store khác (Redis, Postgres...) kế thừa lớp này."""
+
+    @abstractmethod
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """Nhận hoặc gia hạn lease nếu đang trống, hết hạn hoặc đã thuộc owner."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, name: str, owner: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_active(self, prefix: str) -> int:
+        """Đếm lease còn hạn có tên bắt đầu bằng prefix."""
+        raise NotImplementedError
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Lease lưu trong bảng `leases`, dùng được giữa các process cùng truy cập một file SQLite."""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        self.db.execute("INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, 0)", (name, owner))
+        return self.db.update(
+            "UPDATE leases SET owner = ?, expires_at = ? WHERE name = ? AND (owner = ? OR expires_at < ?)",
+            (owner, now + ttl, name, owner, now)
+        ) == 1
+
+    def release(self, name: str, owner: str) -> None:
+        self.db.execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND owner = ?", (name, owner))
+
+    def count_active(self, prefix: str) -> int:
+        return self.db.fetch_one(
+            "SELECT COUNT(*) FROM leases WHERE name LIKE ? AND expires_at >= ?", (prefix + "%", time.time())
+        )[0]
+
+
+def shard_for(user_id: str, num_shards: int) -> int:
+    """Shard ổn định của user (không dùng hash() vì bị random hóa theo process)."""
+    return int(hashlib.sha256(user_id.encode()).hexdigest()[:8], 16) % num_shards
+
+
+class SweepCoordinator:
+    """Chia các shard của sweep lợi nhuận cho các instance đang chạy.
+
+    Mỗi shard là một lease nên tại mọi thời điểm chỉ một instance sở hữu nó; mỗi instance
+    giữ tối đa ceil(số shard / số instance còn sống) shard và nhả phần dư để cân bằng lại.
+    """
+
+    def __init__(self, store: LeaseStore, num_shards: int = 8, ttl: float = 90):
+        self.store = store
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.owned_shards: Set[int] = set()
+
+    def heartbeat(self) -> Set[int]:
+        """Gia hạn lease của instance và các shard đang giữ, nhận thêm hoặc nhả shard cho cân bằng."""
+        self.store.acquire(f"instance:{self.instance_id}", self.instance_id, self.ttl)
+        live_instances = max(1, self.store.count_active("instance:"))
+        target = math.ceil(self.num_shards / live_instances)
+
+        owned = {shard for shard in sorted(self.owned_shards)
+                 if self.store.acquire(f"sweep:shard:{shard}", self.instance_id, self.ttl)}
+        for shard in sorted(owned)[target:]:
+            self.store.release(f"sweep:shard:{shard}", self.instance_id)
+            owned.discard(shard)
+        for shard in range(self.num_shards):
+            if len(owned) >= target:
+                break
+            if shard not in owned and self.store.acquire(f"sweep:shard:{shard}", self.instance_id, self.ttl):
+                owned.add(shard)
+
+        if owned != self.owned_shards:
+            logger.info(f"Instance {self.instance_id} owns sweep shards {sorted(owned)} ({live_instances} live instances)")
+        self.owned_shards = owned
+        return owned
+
+    def filter_users(self, user_ids: List[str]) -> List[str]:
+        """Giữ lại các user thuộc shard mà instance này đang sở hữu."""
+        owned = self.heartbeat()
+        return [user_id for user_id in user_ids if shard_for(user_id, self.num_shards) in owned]
+
+    def shutdown(self) -> None:
+        for shard in self.owned_shards:
+            self.store.release(f"sweep:shard:{shard}", self.instance_id)
+        self.store.release(f"instance:{self.instance_id}", self.instance_id)
+        self.owned_shards = set()
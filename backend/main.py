@@ -1,11 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+import asyncio
 import logging
+import math
+import os
+from datetime import datetime
 from ai_service import AIService
 from defi_service import DeFiService
 from credit_service import CreditService
 from stripe_service import StripeService
+from event_service import event_bus, format_event
+from portfolio_service import PortfolioService
+from outbox_service import OutboxService
+from valuation_service import ValuationService
+from lease_service import SQLiteLeaseStore, SweepCoordinator
+from history_service import HistoryStore
+from database import data_dir
+from repositories import reset_storage
+from admission_service import admission, AdmissionRejected
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.jobstores.base import ConflictingIdError
 
 app = FastAPI()
 
@@ -16,39 +31,158 @@ ai_service = AIService()
 defi_service = DeFiService()
 credit_service = CreditService()
 stripe_service = StripeService()
+valuation_service = ValuationService(defi_service.w3, defi_service.usdc_address, defi_service.weth_address, defi_service.aave_pool)
+history_store = HistoryStore(os.getenv("HISTORY_DIR") or os.path.join(data_dir(), "history"))
+portfolio_service = PortfolioService(defi_service, valuation_service, history_store)
+outbox_service = OutboxService(defi_service, valuation_service)
+# Chia user của sweep cho các worker/replica dùng chung wallets.db
+sweep_coordinator = SweepCoordinator(SQLiteLeaseStore(defi_service.db), num_shards=int(os.getenv("SWEEP_SHARDS", "8")))
 
 # Khởi tạo scheduler
 scheduler = BackgroundScheduler()
+# Task relay event giữa các worker, tạo khi ứng dụng khởi động
+event_relay_task = None
+
+def queue_withdrawal(user_id: str, position: dict):
+    """Đưa lệnh rút vốn vào outbox (idempotency key theo vị thế nên không bị trùng)."""
+    job = outbox_service.enqueue_withdrawal(user_id, position["position_id"], position["platform"], position["initial_value_usd"])
+    logger.info(f"Withdrawal for position {position['position_id']} queued as job {job['job_id']} ({job['status']})")
+
+# Số user định giá trong một lượt multicall của sweep
+SWEEP_BATCH_SIZE = 500
+
+def refresh_user_portfolio(user_id: str):
+    """Cập nhật snapshot danh mục của user và xếp hàng các lệnh rút vốn."""
+    # Không flush lịch sử ở đây: mẫu nằm trong buffer (truy vấn vẫn đọc được) tới lần flush của sweep
+    refresh_portfolios([user_id])
+
+def refresh_portfolios(user_ids: list):
+    for position in portfolio_service.refresh_users(user_ids):
+        queue_withdrawal(position["user_id"], position)
 
 def check_all_users_profits():
     """Kiểm tra lợi nhuận của tất cả user có vị thế active."""
     try:
-        users = defi_service.db.fetch_all("SELECT DISTINCT user_id FROM wallets")
-        for user in users:
-            user_id = user[0]
-            logger.info(f"Checking profits for user: {user_id}")
-            defi_service.check_and_withdraw(user_id)
+        users = defi_service.storage.positions.active_user_ids()
+        users = sweep_coordinator.filter_users(users)
+        logger.info(f"Checking profits for {len(users)} users in shards {sorted(sweep_coordinator.owned_shards)}")
+        for i in range(0, len(users), SWEEP_BATCH_SIZE):
+            refresh_portfolios(users[i:i + SWEEP_BATCH_SIZE])
+        history_store.flush()
     except Exception as e:
         logger.error(f"Error in scheduled profit check: {str(e)}")
 
+def compact_history():
+    """Rollup và xóa lịch sử quá hạn; lease đảm bảo chỉ một instance compact cùng lúc."""
+    owner = sweep_coordinator.instance_id
+    if not sweep_coordinator.store.acquire("history:compact", owner, 3600):
+        return
+    try:
+        history_store.compact()
+    except Exception as e:
+        logger.error(f"Error compacting position history: {str(e)}")
+    finally:
+        sweep_coordinator.store.release("history:compact", owner)
+
 # Thêm scheduler khi ứng dụng khởi động
 @app.on_event("startup")
 async def start_scheduler():
+    global event_relay_task
+    # Relay event qua bảng events để client ở worker khác cũng nhận được event của sweep/outbox
+    event_bus.attach(defi_service.db)
+    event_relay_task = asyncio.create_task(event_bus.run_relay())
     scheduler.add_job(
         check_all_users_profits,
         trigger=IntervalTrigger(minutes=15),  # Kiểm tra mỗi 15 phút
         id="check_profits",
         replace_existing=True
     )
+    scheduler.add_job(
+        sweep_coordinator.heartbeat,
+        trigger=IntervalTrigger(seconds=30),  # Gia hạn lease shard, TTL 90 giây
+        id="sweep_heartbeat",
+        replace_existing=True,
+        next_run_time=datetime.now()
+    )
+    scheduler.add_job(
+        defi_service.gas_oracle.refresh,
+        trigger=IntervalTrigger(seconds=12),  # Làm mới phí và ước tính gas cho user operation
+        id="refresh_gas_oracle",
+        replace_existing=True,
+        next_run_time=datetime.now()
+    )
+    scheduler.add_job(
+        compact_history,
+        trigger=IntervalTrigger(hours=1),  # Rollup theo giờ và áp dụng thời hạn lưu lịch sử
+        id="compact_history",
+        replace_existing=True
+    )
     scheduler.start()
     logger.info("Scheduler started for profit checking every 15 minutes")
+    await outbox_service.start_workers()
 
 # Tắt scheduler khi ứng dụng dừng
 @app.on_event("shutdown")
 async def shutdown_scheduler():
+    await outbox_service.stop_workers()
     scheduler.shutdown()
+    history_store.flush()
+    sweep_coordinator.shutdown()
+    event_relay_task.cancel()
+    event_bus.sync()
+    reset_storage()
     logger.info("Scheduler shut down")
 
+# Khoảng thời gian gửi heartbeat để giữ kết nối push qua proxy
+EVENT_HEARTBEAT_SECONDS = 15
+
+@app.get("/events/{user_id}")
+async def stream_events(user_id: str):
+    """Đẩy event của user qua Server-Sent Events."""
+    subscription = event_bus.subscribe(user_id)
+
+    async def event_stream():
+        try:
+            yield ": connected\n\n"
+            while True:
+                batch = await subscription.next_batch(timeout=EVENT_HEARTBEAT_SECONDS)
+                if not batch:
+                    yield ": heartbeat\n\n"
+                    continue
+                for event in batch:
+                    yield f"event: {event['type']}\ndata: {format_event(event)}\n\n"
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/{user_id}")
+async def websocket_events(websocket: WebSocket, user_id: str):
+    """Đẩy event của user qua WebSocket."""
+    await websocket.accept()
+    subscription = event_bus.subscribe(user_id)
+    try:
+        while True:
+            batch = await subscription.next_batch(timeout=EVENT_HEARTBEAT_SECONDS)
+            if not batch:
+                await websocket.send_text('{"type": "heartbeat"}')
+                continue
+            for event in batch:
+                await websocket.send_text(format_event(event))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_bus.unsubscribe(subscription)
+
+def _time_range(request: dict):
+    """Đọc khoảng thời gian (unix timestamp, giây) cho các truy vấn lịch sử."""
+    start, end = request.get("start"), request.get("end")
+    return int(start) if start is not None else None, int(end) if end is not None else None
+
 @app.post("/ai_credit_endpoint")
 async def endpoint(request: dict):
     action = request.get("action")
@@ -59,6 +193,8 @@ async def endpoint(request: dict):
         raise HTTPException(status_code=400, detail="user_id is required")
 
     try:
+        admission.check_rate(user_id, action)
+
         if action == "credits":
             credits = credit_service.check_credits(user_id)
             return {"credits_remaining": credits}
@@ -76,31 +212,42 @@ async def endpoint(request: dict):
             amount_eth = float(request.get("amount_eth", 0))
             if amount_eth <= 0:
                 raise ValueError("Invalid amount_eth")
-            result = defi_service.fund_ai_wallet(user_id, amount_eth)
-            return result
+            return outbox_service.enqueue_fund_ai_wallet(user_id, amount_eth, request.get("idempotency_key"))
 
         elif action == "swap":
             amount_in = int(request.get("amount_in", 0))
             if amount_in <= 0:
                 raise ValueError("Invalid amount_in")
-            return defi_service.swap_usdc_to_eth(amount_in, user_id)
+            return outbox_service.enqueue_swap(user_id, amount_in, request.get("idempotency_key"))
 
         elif action == "supply":
             amount = int(request.get("amount", 0))
             if amount <= 0:
                 raise ValueError("Invalid amount")
-            return defi_service.supply_usdc(amount, user_id)
+            return outbox_service.enqueue_supply(user_id, amount, request.get("idempotency_key"))
+
+        elif action == "job_status":
+            job_id = int(request.get("job_id", 0))
+            if job_id <= 0:
+                raise ValueError("Invalid job_id")
+            return outbox_service.get_job(job_id, user_id)
 
         elif action == "ask":
             question = request.get("question")
             model = request.get("model", "anthropic")
             if not question:
                 raise ValueError("question is required")
-            if not credit_service.deduct_credits(user_id, model):
-                raise ValueError("Insufficient credits")
-            response = ai_service.ask_question(question, model, user_id)
+            # Giữ chỗ LLM trước khi trừ credits để request bị từ chối không mất credits
+            async with admission.dependency("llm").slot_async():
+                if not credit_service.deduct_credits(user_id, model):
+                    raise ValueError("Insufficient credits")
+                response = await asyncio.to_thread(ai_service.ask_question, question, model, user_id)
             return {"response": response}
 
+        elif action == "reset_conversation":
+            ai_service.conversations.clear(user_id)
+            return {"status": "success"}
+
         elif action == "buy_credits":
             amount = int(request.get("amount", 0))
             if amount <= 0:
@@ -123,65 +270,37 @@ async def endpoint(request: dict):
             return {"status": "success"}
 
         elif action == "check_profits":
-            # Lấy tất cả vị thế active của user
-            positions = defi_service.db.fetch_all(
-                "SELECT position_id, platform, initial_value_usd FROM positions WHERE user_id = ? AND status = 'active'",
-                (user_id,)
+            snapshot = portfolio_service.get_snapshot(user_id)
+            if snapshot.get("stale"):
+                # Vị thế mới chưa có snapshot: định giá trong nền, không chặn request
+                try:
+                    scheduler.add_job(refresh_user_portfolio, args=(user_id,), id=f"refresh_{user_id}", misfire_grace_time=None)
+                except ConflictingIdError:
+                    pass
+            return snapshot
+
+        elif action == "position_history":
+            position_id = request.get("position_id")
+            start, end = _time_range(request)
+            history = await asyncio.to_thread(
+                history_store.query, user_id, int(position_id) if position_id is not None else None,
+                start, end, request.get("resolution", "raw")
             )
-            if not positions:
-                return {"status": "no_active_positions"}
-
-            results = []
-            for position_id, platform, initial_value_usd in positions:
-                # Tính giá trị hiện tại và profit ratio
-                if platform == "aave":
-                    current_value = defi_service.get_aave_position_value(user_id, position_id)
-                elif platform == "uniswap":
-                    current_value = defi_service.get_uniswap_position_value(user_id, position_id)
-                else:
-                    continue
+            return {"history": history.astype({"platform": str}).to_dict("records") if not history.empty else []}
 
-                profit_ratio = current_value / initial_value_usd
-                position_info = {
-                    "position_id": position_id,
-                    "platform": platform,
-                    "initial_value_usd": initial_value_usd,
-                    "current_value_usd": current_value,
-                    "profit_ratio": profit_ratio,
-                    "action_taken": None
-                }
-
-                # Kiểm tra và rút vốn nếu cần
-                if profit_ratio >= 1.05 or profit_ratio <= 0.99:
-                    wallet_address, nonce = defi_service.get_wallet(user_id)
-                    if not wallet_address:
-                        raise Exception("AA wallet not found for user")
-                    
-                    if platform == "aave":
-                        user_op = defi_service.create_user_op(wallet_address, "withdraw", int(initial_value_usd), nonce, wallet_address)
-                    elif platform == "uniswap":
-                        user_op = defi_service.create_user_op(wallet_address, "transfer", int(initial_value_usd), nonce, wallet_address)
-                    
-                    result = defi_service.send_to_bundler(user_op)
-                    if "error" in result:
-                        position_info["action_taken"] = f"Failed to withdraw: {result['error']}"
-                    else:
-                        defi_service.update_nonce(user_id, nonce + 1)
-                        defi_service.db.execute(
-                            "UPDATE positions SET status = 'closed' WHERE position_id = ?", (position_id,)
-                        )
-                        position_info["action_taken"] = f"Withdrawn (Tx hash: {result.get('result', 'pending')})"
-                        logger.info(f"Withdrawn {platform} position {position_id} for {user_id}. Profit ratio: {profit_ratio}")
-                else:
-                    position_info["action_taken"] = "No action needed"
-
-                results.append(position_info)
-
-            return {"status": "checked", "positions": results}
+        elif action == "backtest_thresholds":
+            thresholds = [(float(tp), float(sl)) for tp, sl in request.get("thresholds", [])]
+            if not thresholds or any(sl >= tp for tp, sl in thresholds):
+                raise ValueError("thresholds must be a list of [take_profit, stop_loss] with stop_loss < take_profit")
+            start, end = _time_range(request)
+            results = await asyncio.to_thread(history_store.backtest, thresholds, user_id, start, end)
+            return {"results": results}
 
         else:
             raise ValueError(f"Invalid action: {action}")
 
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -0,0 +1,335 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from defi_service import DeFiService
+from event_service import event_bus
+from valuation_service import ValuationService
+from admission_service import AdmissionRejected
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AI_AGENT_WALLET = "AI_AGENT_WALLET"
+
+# Điều kiện worker vẫn giữ lease của job: locked_until đúng giá trị lúc claim hoặc gia hạn gần nhất
+LEASE_CONDITION = "job_id = ? AND status = 'running' AND locked_until = ?"
+
+
+class OutboxService:
+    """Hàng đợi bền vững (bảng outbox_jobs) cho các hành động on-chain.
+
+    Handler chỉ ghi intent và trả về job_id; worker nền build, ký và gửi user operation.
+    Job của cùng một ví chạy tuần tự theo job_id, job của các ví khác nhau chạy song song.
+    User operation đã ký được lưu trước khi gửi, nên sau khi crash worker gửi lại đúng op đó
+    thay vì tạo op mới; nonce, vị thế và trạng thái job được ghi cùng lúc qua `Storage.commit`.
+    """
+
+    def __init__(self, defi_service: DeFiService, valuation_service: Optional[ValuationService] = None, workers: int = 4,
+                 poll_interval: float = 1.0, max_attempts: int = 5, lease_seconds: int = 120):
+        self.defi_service = defi_service
+        self.valuation_service = valuation_service
+        self.storage = defi_service.storage
+        self.db = defi_service.db
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._tasks: List[asyncio.Task] = []
+
+    def enqueue(self, user_id: str, action: str, steps: List[Dict], effects: Optional[List[Dict]] = None,
+                on_failure: Optional[List[Dict]] = None, wallet_key: Optional[str] = None,
+                idempotency_key: Optional[str] = None, depends_on: Optional[int] = None) -> Dict:
+        """Ghi intent vào outbox; cùng idempotency_key trả về job đã có.
+
+        Job thất bại hẳn sẽ nhả idempotency_key để có thể gửi lại.
+        """
+        wallet_key = wallet_key or user_id
+        if not self.defi_service.get_wallet(wallet_key)[0]:
+            raise ValueError("AA wallet not found for user")
+
+        if idempotency_key:
+            existing = self.db.fetch_one(
+                "SELECT job_id, status FROM outbox_jobs WHERE idempotency_key = ?", (idempotency_key,)
+            )
+            if existing:
+                return {"job_id": existing[0], "status": existing[1]}
+
+        now = int(time.time())
+        payload = json.dumps({"steps": steps, "effects": effects or [], "on_failure": on_failure or []})
+        job_id = self.db.execute(
+            "INSERT OR IGNORE INTO outbox_jobs (idempotency_key, user_id, wallet_key, action, payload, depends_on, next_attempt_at, result, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (idempotency_key, user_id, wallet_key, action, payload, depends_on, now, "[]", now, now)
+        )
+        if idempotency_key:
+            # Request song song cùng key: INSERT bị bỏ qua, trả về job đã được tạo
+            job_id, status = self.db.fetch_one(
+                "SELECT job_id, status FROM outbox_jobs WHERE idempotency_key = ?", (idempotency_key,)
+            )
+            return {"job_id": job_id, "status": status}
+        logger.info(f"Queued {action} job {job_id} for {user_id}")
+        return {"job_id": job_id, "status": "pending"}
+
+    def enqueue_swap(self, user_id: str, amount_in: int, idempotency_key: Optional[str] = None) -> Dict:
+        return self.enqueue(user_id, "swap", steps=[
+            {"action_type": "approve", "amount": amount_in, "recipient": self.defi_service.uniswap_router},
+            {"action_type": "swap", "amount": amount_in}
+        ], effects=[{"type": "open_position", "platform": "uniswap", "amount": amount_in}], idempotency_key=idempotency_key)
+
+    def enqueue_supply(self, user_id: str, amount: int, idempotency_key: Optional[str] = None) -> Dict:
+        return self.enqueue(user_id, "supply", steps=[
+            {"action_type": "supply", "amount": amount}
+        ], effects=[{"type": "open_position", "platform": "aave", "amount": amount}], idempotency_key=idempotency_key)
+
+    def enqueue_fund_ai_wallet(self, user_id: str, amount_eth: float, idempotency_key: Optional[str] = None) -> Dict:
+        amount_wei = self.defi_service.w3.to_wei(amount_eth, 'ether')
+        return self.enqueue(user_id, "fund_ai_wallet", steps=[
+            {"action_type": "fund", "amount_wei": amount_wei}
+        ], idempotency_key=idempotency_key)
+
+    def enqueue_withdrawal(self, user_id: str, position_id: int, platform: str, initial_value_usd: float) -> Dict:
+        """Rút vốn một vị thế về ví AA của user (mỗi vị thế tối đa một job đang chạy)."""
+        wallet_address, _ = self.defi_service.get_wallet(user_id)
+        action_type = "withdraw" if platform == "aave" else "transfer"
+        return self.enqueue(user_id, "withdraw_position", steps=[
+            {"action_type": action_type, "amount": int(initial_value_usd), "recipient": wallet_address}
+        ], effects=[{"type": "close_position", "position_id": position_id, "platform": platform}],
+            on_failure=[{"type": "snapshot_action", "position_id": position_id, "action": "withdraw_failed"}],
+            idempotency_key=f"withdraw:{position_id}")
+
+    def get_job(self, job_id: int, user_id: Optional[str] = None) -> Dict:
+        row = self.db.fetch_one(
+            "SELECT job_id, user_id, action, status, step, attempts, result, error, created_at, updated_at FROM outbox_jobs WHERE job_id = ?",
+            (job_id,)
+        )
+        if not row or (user_id and row[1] != user_id):
+            raise ValueError("Job not found")
+        job_id, user_id, action, status, step, attempts, result, error, created_at, updated_at = row
+        return {
+            "job_id": job_id,
+            "action": action,
+            "status": status,
+            "steps_completed": step,
+            "attempts": attempts,
+            "user_op_hashes": json.loads(result or "[]"),
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+    async def start_workers(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} outbox workers")
+
+    async def stop_workers(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Outbox workers stopped")
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            try:
+                job = self._claim_job()
+                if not job:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox worker {worker_id} error: {str(e)}")
+                await asyncio.sleep(self.poll_interval)
+
+    def _claim_job(self) -> Optional[Dict]:
+        """Nhận job sẵn sàng cũ nhất mà không có job trước đó của cùng ví còn dang dở."""
+        now = time.time()
+        candidates = self.db.fetch_all(
+            """SELECT j.job_id FROM outbox_jobs j
+               WHERE ((j.status = 'pending' AND j.next_attempt_at <= ?) OR (j.status = 'running' AND j.locked_until < ?))
+                 AND NOT EXISTS (SELECT 1 FROM outbox_jobs o WHERE o.wallet_key = j.wallet_key AND o.job_id < j.job_id
+                                 AND o.status IN ('pending', 'running'))
+                 AND (j.depends_on IS NULL OR EXISTS (SELECT 1 FROM outbox_jobs d WHERE d.job_id = j.depends_on
+                                                      AND d.status IN ('done', 'failed')))
+               ORDER BY j.next_attempt_at LIMIT 10""",
+            (now, now)
+        )
+        locked_until = now + self.lease_seconds
+        for (job_id,) in candidates:
+            claimed = self.db.update(
+                """UPDATE outbox_jobs SET status = 'running', locked_until = ?, attempts = attempts + 1, updated_at = ?
+                   WHERE job_id = ? AND (status = 'pending' OR (status = 'running' AND locked_until < ?))""",
+                (locked_until, int(now), job_id, now)
+            )
+            if claimed:
+                row = self.db.fetch_one(
+                    "SELECT job_id, user_id, wallet_key, action, payload, depends_on, step, signed_op, attempts, result FROM outbox_jobs WHERE job_id = ?",
+                    (job_id,)
+                )
+                job = dict(zip(("job_id", "user_id", "wallet_key", "action", "payload", "depends_on", "step", "signed_op", "attempts", "result"), row))
+                job["locked_until"] = locked_until
+                return job
+        return None
+
+    def _build_step_op(self, wallet_address: str, step: Dict, nonce: int) -> Dict:
+        if step["action_type"] == "fund":
+            user_op = self.defi_service._create_basic_user_op(wallet_address, nonce, "fund")
+            user_op.update({"value": step["amount_wei"], "to": self.defi_service.ai_wallet_address})
+            return user_op
+        return self.defi_service.create_user_op(wallet_address, step["action_type"], step["amount"], nonce, step.get("recipient"))
+
+    async def _run_job(self, job: Dict) -> None:
+        job_id, user_id, wallet_key = job["job_id"], job["user_id"], job["wallet_key"]
+        payload = json.loads(job["payload"])
+        steps = payload["steps"]
+        hashes = json.loads(job["result"] or "[]")
+        signed_op = json.loads(job["signed_op"]) if job["signed_op"] else None
+
+        try:
+            if job["depends_on"]:
+                dependency = self.db.fetch_one("SELECT status FROM outbox_jobs WHERE job_id = ?", (job["depends_on"],))
+                if not dependency or dependency[0] != "done":
+                    self._fail_job(job, payload, f"Dependency job {job['depends_on']} failed", permanent=True)
+                    return
+
+            wallet_address, _ = self.defi_service.get_wallet(wallet_key)
+            if not wallet_address:
+                self._fail_job(job, payload, "AA wallet not found for user", permanent=True)
+                return
+
+            for index in range(job["step"], len(steps)):
+                user_op_hash = None
+                if signed_op:
+                    # Retry sau lỗi/crash: nếu op đã được đưa lên chain thì không gửi lại
+                    onchain_nonce = await asyncio.to_thread(self.defi_service.get_onchain_nonce, wallet_address)
+                    if onchain_nonce > signed_op["nonce"]:
+                        user_op_hash = "included"
+                else:
+                    # wallets.nonce có thể tụt sau nonce trên EntryPoint (op gửi ngoài outbox, DB khôi phục)
+                    _, db_nonce = self.defi_service.get_wallet(wallet_key)
+                    onchain_nonce = await asyncio.to_thread(self.defi_service.get_onchain_nonce, wallet_address)
+                    nonce = max(db_nonce, onchain_nonce)
+                    signed_op = await asyncio.to_thread(
+                        self.defi_service.sign_user_op, self._build_step_op(wallet_address, steps[index], nonce)
+                    )
+                    if not self.db.update(
+                        f"UPDATE outbox_jobs SET signed_op = ?, updated_at = ? WHERE {LEASE_CONDITION}",
+                        (json.dumps(signed_op), int(time.time()), job_id, job["locked_until"])
+                    ):
+                        self._lease_lost(job)
+                        return
+
+                if not user_op_hash:
+                    result = await self.defi_service.send_user_op_async(signed_op, user_id)
+                    user_op_hash = result.get("result", "pending")
+                hashes.append(user_op_hash)
+
+                done = index == len(steps) - 1
+                locked_until = time.time() + self.lease_seconds
+                # Chỉ worker còn giữ lease và đang ở đúng bước mới được hoàn tất bước này
+                guard = (
+                    f"UPDATE outbox_jobs SET step = ?, signed_op = NULL, result = ?, status = ?, locked_until = ?, error = NULL, updated_at = ? WHERE {LEASE_CONDITION} AND step = ?",
+                    (index + 1, json.dumps(hashes), "done" if done else "running", locked_until, int(time.time()),
+                     job_id, job["locked_until"], index)
+                )
+                statements = []
+                operations = [(self.storage.wallets, "bump_nonce", (wallet_key, signed_op["nonce"] + 1))]
+                if done:
+                    marks = await self._get_entry_marks(payload["effects"])
+                    statements, operations_done = self._effects(user_id, payload["effects"], marks)
+                    operations += operations_done
+                if not self.storage.commit(statements, operations, guard):
+                    self._lease_lost(job)
+                    return
+                job["locked_until"] = locked_until
+                signed_op = None
+
+            logger.info(f"Completed {job['action']} job {job_id} for {user_id}: {hashes}")
+            event_bus.publish(user_id, "job", {"job_id": job_id, "action": job["action"], "status": "done", "user_op_hashes": hashes})
+            if job["action"] == "withdraw_position":
+                effect = payload["effects"][0]
+                event_bus.publish(user_id, "withdrawal", {
+                    "position_id": effect["position_id"],
+                    "platform": effect["platform"],
+                    "user_op_hash": hashes[-1]
+                })
+        except AdmissionRejected as e:
+            # Dependency quá tải: hoãn job, không tính là một lần thử
+            self.db.update(
+                f"UPDATE outbox_jobs SET status = 'pending', attempts = attempts - 1, locked_until = NULL, next_attempt_at = ?, updated_at = ? WHERE {LEASE_CONDITION}",
+                (time.time() + e.retry_after, int(time.time()), job_id, job["locked_until"])
+            )
+        except Exception as e:
+            logger.error(f"Outbox job {job_id} ({job['action']}) failed on attempt {job['attempts']}: {str(e)}")
+            self._fail_job(job, payload, str(e), permanent=job["attempts"] >= self.max_attempts)
+
+    def _lease_lost(self, job: Dict) -> None:
+        logger.warning(f"Outbox job {job['job_id']} ({job['action']}) lease expired and was reclaimed, dropping stale result")
+
+    def _fail_job(self, job: Dict, payload: Dict, error: str, permanent: bool) -> None:
+        now = int(time.time())
+        if permanent:
+            effect_statements, effect_operations = self._effects(job["user_id"], payload["on_failure"])
+            guard = (
+                f"UPDATE outbox_jobs SET status = 'failed', idempotency_key = NULL, locked_until = NULL, error = ?, updated_at = ? WHERE {LEASE_CONDITION}",
+                (error, now, job["job_id"], job["locked_until"])
+            )
+            if not self.storage.commit(effect_statements, effect_operations, guard):
+                self._lease_lost(job)
+                return
+            event_bus.publish(job["user_id"], "job", {"job_id": job["job_id"], "action": job["action"], "status": "failed", "error": error})
+            return
+
+        # Exponential backoff có jitter; signed_op được giữ lại để gửi lại đúng op cũ
+        delay = min(2 ** job["attempts"], 300) * (0.5 + random.random())
+        if not self.db.update(
+            f"UPDATE outbox_jobs SET status = 'pending', locked_until = NULL, next_attempt_at = ?, error = ?, updated_at = ? WHERE {LEASE_CONDITION}",
+            (time.time() + delay, error, now, job["job_id"], job["locked_until"])
+        ):
+            self._lease_lost(job)
+            return
+        event_bus.publish(job["user_id"], "job", {"job_id": job["job_id"], "action": job["action"], "status": "retrying", "error": error})
+
+    async def _get_entry_marks(self, effects: List[Dict]) -> Dict:
+        """Đọc mốc định giá on-chain cho vị thế mới mở (không chặn hoàn tất job nếu lỗi)."""
+        if not self.valuation_service or not any(effect["type"] == "open_position" for effect in effects):
+            return {}
+        try:
+            return await asyncio.to_thread(self.valuation_service.get_entry_marks)
+        except Exception as e:
+            logger.error(f"Failed to read entry marks: {str(e)}")
+            return {}
+
+    def _effects(self, user_id: str, effects: List[Dict], marks: Optional[Dict] = None) -> Tuple[List[tuple], List[tuple]]:
+        """Chuyển effects của job thành câu lệnh SQL và thao tác repository, ghi cùng lúc hoàn tất job."""
+        statements = []
+        operations = []
+        now = int(time.time())
+        marks = marks or {}
+        for effect in effects:
+            if effect["type"] == "open_position":
+                operations.append((self.storage.positions, "open", (
+                    user_id, effect["platform"], effect["amount"], effect["amount"], now,
+                    marks.get("entry_index") if effect["platform"] == "aave" else None,
+                    marks.get("entry_sqrt_price_x96") if effect["platform"] == "uniswap" else None
+                )))
+            elif effect["type"] == "close_position":
+                operations.append((self.storage.positions, "close", (effect["position_id"],)))
+                statements.append((
+                    "UPDATE position_snapshots SET last_action = 'withdrawn', updated_at = ? WHERE position_id = ?",
+                    (now, effect["position_id"])
+                ))
+            elif effect["type"] == "snapshot_action":
+                statements.append((
+                    "UPDATE position_snapshots SET last_action = ?, updated_at = ? WHERE position_id = ?",
+                    (effect["action"], now, effect["position_id"])
+                ))
+            else:
+                raise ValueError(f"Unsupported effect: {effect['type']}")
+        return statements, operations
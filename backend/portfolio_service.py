@@ -0,0 +1,156 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+from defi_service import DeFiService
+from event_service import event_bus
+from history_service import HistoryStore
+from valuation_service import ValuationService
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ngưỡng tự động rút vốn: chốt lời và cắt lỗ
+TAKE_PROFIT_RATIO = 1.05
+STOP_LOSS_RATIO = 0.99
+
+
+def should_withdraw(profit_ratio: float) -> bool:
+    return profit_ratio >= TAKE_PROFIT_RATIO or profit_ratio <= STOP_LOSS_RATIO
+
+
+class PortfolioService:
+    """Snapshot danh mục theo user do sweep nền cập nhật.
+
+    `refresh_users` định giá vị thế và ghi snapshot; `get_snapshot` chỉ đọc snapshot,
+    nên request của user không phải định giá lại hay gọi bundler. Lệnh rút vốn do
+    outbox thực hiện. Mỗi lần định giá cũng được ghi thêm vào `history_store` nếu có.
+    """
+
+    def __init__(self, defi_service: DeFiService, valuation_service: ValuationService, history_store: Optional[HistoryStore] = None):
+        self.defi_service = defi_service
+        self.valuation_service = valuation_service
+        self.history_store = history_store
+        self.positions = defi_service.storage.positions
+        self.db = defi_service.db
+
+    def refresh_users(self, user_ids: List[str]) -> List[Dict]:
+        """Định giá lại các vị thế active của nhóm user (một lượt multicall) và cập nhật snapshot.
+
+        Trả về các vị thế vượt ngưỡng cần được đưa vào hàng đợi rút vốn.
+        """
+        if not user_ids:
+            return []
+        positions = self.positions.list_active(user_ids)
+        snapshots = self._get_snapshot_rows([p["position_id"] for p in positions])
+        for position in positions:
+            position["last_action"] = snapshots.get(position["position_id"], (None,) * 4)[2]
+        values = self.valuation_service.value_positions(positions)
+
+        now = int(time.time())
+        statements = []
+        to_withdraw = []
+        totals = {user_id: [0, 0.0, 0.0] for user_id in user_ids}
+        # User có vị thế chưa định giá được giữ tổng cũ thay vì ghi tổng thiếu
+        incomplete = set()
+
+        for position in positions:
+            position_id, user_id, platform = position["position_id"], position["user_id"], position["platform"]
+            initial_value_usd = position["initial_value_usd"]
+            current_value = values.get(position_id)
+            if current_value is None:
+                incomplete.add(user_id)
+                continue
+
+            profit_ratio = current_value / initial_value_usd
+            if position["last_action"] == "withdraw_queued" or should_withdraw(profit_ratio):
+                action = "withdraw_queued"
+                to_withdraw.append({
+                    "user_id": user_id,
+                    "position_id": position_id,
+                    "platform": platform,
+                    "initial_value_usd": initial_value_usd,
+                    "profit_ratio": profit_ratio
+                })
+            else:
+                action = "hold"
+
+            statements.append((
+                # Không ghi đè trạng thái do outbox ghi khi lệnh rút hoàn tất
+                """INSERT INTO position_snapshots (position_id, user_id, platform, initial_value_usd, current_value_usd, profit_ratio, last_action, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(position_id) DO UPDATE SET
+                       current_value_usd = excluded.current_value_usd,
+                       profit_ratio = excluded.profit_ratio,
+                       last_action = CASE WHEN position_snapshots.last_action = 'withdrawn'
+                                          THEN position_snapshots.last_action ELSE excluded.last_action END,
+                       updated_at = excluded.updated_at""",
+                (position_id, user_id, platform, initial_value_usd, current_value, profit_ratio, action, now)
+            ))
+            if self.history_store:
+                self.history_store.append(now, user_id, position_id, platform, current_value, profit_ratio)
+            user_totals = totals[user_id]
+            user_totals[0] += 1
+            user_totals[1] += initial_value_usd
+            user_totals[2] += current_value
+            event_bus.publish(user_id, "position_value", {
+                "position_id": position_id,
+                "platform": platform,
+                "initial_value_usd": initial_value_usd,
+                "current_value_usd": current_value,
+                "profit_ratio": profit_ratio
+            }, coalesce_key=f"position_value:{position_id}")
+
+        for user_id, (position_count, total_initial, total_current) in totals.items():
+            if user_id in incomplete:
+                continue
+            statements.append((
+                "INSERT OR REPLACE INTO portfolio_totals (user_id, position_count, total_initial_value_usd, total_current_value_usd, profit_ratio, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, position_count, total_initial, total_current, total_current / total_initial if total_initial else None, now)
+            ))
+        self.db.execute_batch(statements)
+        return to_withdraw
+
+    def _get_snapshot_rows(self, position_ids: List[int]) -> Dict[int, tuple]:
+        """position_id -> (current_value_usd, profit_ratio, last_action, updated_at)."""
+        if not position_ids:
+            return {}
+        placeholders = ", ".join("?" for _ in position_ids)
+        rows = self.db.fetch_all(
+            f"""SELECT position_id, current_value_usd, profit_ratio, last_action, updated_at
+                FROM position_snapshots WHERE position_id IN ({placeholders})""",
+            tuple(position_ids)
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def get_snapshot(self, user_id: str) -> Dict:
+        """Đọc snapshot danh mục của user (không định giá lại)."""
+        active = self.positions.list_active([user_id])
+        if not active:
+            return {"status": "no_active_positions"}
+
+        snapshots = self._get_snapshot_rows([p["position_id"] for p in active])
+        positions = []
+        for position in active:
+            current_value_usd, profit_ratio, last_action, updated_at = snapshots.get(position["position_id"], (None,) * 4)
+            positions.append({
+                "position_id": position["position_id"],
+                "platform": position["platform"],
+                "initial_value_usd": position["initial_value_usd"],
+                "current_value_usd": current_value_usd,
+                "profit_ratio": profit_ratio,
+                "action_taken": last_action,
+                "updated_at": updated_at
+            })
+
+        totals = self.db.fetch_one(
+            "SELECT position_count, total_initial_value_usd, total_current_value_usd, profit_ratio, updated_at FROM portfolio_totals WHERE user_id = ?",
+            (user_id,)
+        )
+        return {
+            "status": "checked",
+            "positions": positions,
+            "totals": dict(zip(("position_count", "total_initial_value_usd", "total_current_value_usd", "profit_ratio", "updated_at"), totals)) if totals else None,
+            # Vị thế mới chưa được sweep định giá lần nào
+            "stale": any(p["updated_at"] is None for p in positions)
+        }
@@ -0,0 +1,332 @@
+import itertools
+import logging
+import os
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from database import Database
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ("sqlite", "memory", "dict")
+
+# Cột của một vị thế trả về bởi PositionRepository
+POSITION_FIELDS = ("position_id", "user_id", "platform", "initial_amount", "initial_value_usd", "start_time",
+                   "status", "entry_index", "entry_sqrt_price_x96")
+
+
+class WalletRepository(ABC):
+    """Ví AA và nonce theo user."""
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[Tuple[str, int]]:
+        """Trả về (wallet_address, nonce) hoặc None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, user_id: str, wallet_address: str) -> None:
+        """Lưu (hoặc thay) ví của user với nonce 0."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def bump_nonce(self, user_id: str, nonce: int) -> None:
+        """Đặt nonce thành max(nonce hiện tại, nonce) để nonce không lùi khi nhiều worker cùng ghi."""
+        raise NotImplementedError
+
+
+class PositionRepository(ABC):
+    """Vị thế yield farming của user."""
+
+    @abstractmethod
+    def open(self, user_id: str, platform: str, initial_amount: float, initial_value_usd: float, start_time: int,
+             entry_index: Optional[str] = None, entry_sqrt_price_x96: Optional[str] = None) -> int:
+        """Mở vị thế mới, trả về position_id."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self, position_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, position_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_active(self, user_ids: Sequence[str]) -> List[Dict]:
+        """Các vị thế active của nhóm user, kèm wallet_address của user."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def active_user_ids(self) -> List[str]:
+        raise NotImplementedError
+
+
+class CreditRepository(ABC):
+    """Số dư AI credits theo user."""
+
+    @abstractmethod
+    def get(self, user_id: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def deduct(self, user_id: str, amount: int) -> bool:
+        """Trừ nguyên tử nếu đủ số dư; trả về False nếu không đủ."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, user_id: str, amount: int) -> None:
+        raise NotImplementedError
+
+
+class SQLiteWalletRepository(WalletRepository):
+    def __init__(self, db: Database):
+        self.db = db
+
+    def get(self, user_id: str) -> Optional[Tuple[str, int]]:
+        return self.db.fetch_one("SELECT wallet_address, nonce FROM wallets WHERE user_id = ?", (user_id,))
+
+    def save_statements(self, user_id: str, wallet_address: str) -> List[tuple]:
+        return [("INSERT OR REPLACE INTO wallets (user_id, wallet_address, nonce) VALUES (?, ?, ?)", (user_id, wallet_address, 0))]
+
+    def save(self, user_id: str, wallet_address: str) -> None:
+        self.db.execute_batch(self.save_statements(user_id, wallet_address))
+
+    def bump_nonce_statements(self, user_id: str, nonce: int) -> List[tuple]:
+        return [("UPDATE wallets SET nonce = MAX(nonce, ?) WHERE user_id = ?", (nonce, user_id))]
+
+    def bump_nonce(self, user_id: str, nonce: int) -> None:
+        self.db.execute_batch(self.bump_nonce_statements(user_id, nonce))
+
+
+class SQLitePositionRepository(PositionRepository):
+    def __init__(self, db: Database):
+        self.db = db
+
+    def open_statements(self, user_id: str, platform: str, initial_amount: float, initial_value_usd: float, start_time: int,
+                        entry_index: Optional[str] = None, entry_sqrt_price_x96: Optional[str] = None) -> List[tuple]:
+        return [(
+            "INSERT INTO positions (user_id, platform, initial_amount, initial_value_usd, start_time, entry_index, entry_sqrt_price_x96) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, platform, initial_amount, initial_value_usd, start_time, entry_index, entry_sqrt_price_x96)
+        )]
+
+    def open(self, user_id: str, platform: str, initial_amount: float, initial_value_usd: float, start_time: int,
+             entry_index: Optional[str] = None, entry_sqrt_price_x96: Optional[str] = None) -> int:
+        (query, params), = self.open_statements(user_id, platform, initial_amount, initial_value_usd, start_time,
+                                                entry_index, entry_sqrt_price_x96)
+        return self.db.execute(query, params)
+
+    def close_statements(self, position_id: int) -> List[tuple]:
+        return [("UPDATE positions SET status = 'closed' WHERE position_id = ?", (position_id,))]
+
+    def close(self, position_id: int) -> None:
+        self.db.execute_batch(self.close_statements(position_id))
+
+    def get(self, position_id: int) -> Optional[Dict]:
+        row = self.db.fetch_one(f"SELECT {', '.join(POSITION_FIELDS)} FROM positions WHERE position_id = ?", (position_id,))
+        return dict(zip(POSITION_FIELDS, row)) if row else None
+
+    def list_active(self, user_ids: Sequence[str]) -> List[Dict]:
+        if not user_ids:
+            return []
+        placeholders = ", ".join("?" for _ in user_ids)
+        rows = self.db.fetch_all(
+            f"""SELECT {', '.join('p.' + field for field in POSITION_FIELDS)}, w.wallet_address
+                FROM positions p JOIN wallets w ON w.user_id = p.user_id
+                WHERE p.user_id IN ({placeholders}) AND p.status = 'active'""",
+            tuple(user_ids)
+        )
+        return [dict(zip(POSITION_FIELDS + ("wallet_address",), row)) for row in rows]
+
+    def active_user_ids(self) -> List[str]:
+        return [row[0] for row in self.db.fetch_all("SELECT DISTINCT user_id FROM positions WHERE status = 'active'")]
+
+
+class SQLiteCreditRepository(CreditRepository):
+    def __init__(self, db: Database):
+        self.db = db
+
+    def get(self, user_id: str) -> int:
+        result = self.db.fetch_one("SELECT credits FROM credits WHERE user_id = ?", (user_id,))
+        return result[0] if result else 0
+
+    def deduct(self, user_id: str, amount: int) -> bool:
+        # Trừ nguyên tử để nhiều worker không cùng trừ trên một số dư cũ
+        return self.db.update(
+            "UPDATE credits SET credits = credits - ? WHERE user_id = ? AND credits >= ?", (amount, user_id, amount)
+        ) == 1
+
+    def add(self, user_id: str, amount: int) -> None:
+        self.db.execute(
+            "INSERT INTO credits (user_id, credits) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET credits = credits + excluded.credits",
+            (user_id, amount)
+        )
+
+
+class DictWalletRepository(WalletRepository):
+    def __init__(self):
+        self._wallets: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[Tuple[str, int]]:
+        wallet = self._wallets.get(user_id)
+        return (wallet[0], wallet[1]) if wallet else None
+
+    def save(self, user_id: str, wallet_address: str) -> None:
+        with self._lock:
+            self._wallets[user_id] = [wallet_address, 0]
+
+    def bump_nonce(self, user_id: str, nonce: int) -> None:
+        with self._lock:
+            wallet = self._wallets.get(user_id)
+            if wallet:
+                wallet[1] = max(wallet[1], nonce)
+
+
+class DictPositionRepository(PositionRepository):
+    def __init__(self, wallets: DictWalletRepository):
+        self.wallets = wallets
+        self._positions: Dict[int, Dict] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def open(self, user_id: str, platform: str, initial_amount: float, initial_value_usd: float, start_time: int,
+             entry_index: Optional[str] = None, entry_sqrt_price_x96: Optional[str] = None) -> int:
+        with self._lock:
+            position_id = next(self._ids)
+            self._positions[position_id] = dict(zip(POSITION_FIELDS, (
+                position_id, user_id, platform, initial_amount, initial_value_usd, start_time, "active",
+                entry_index, entry_sqrt_price_x96
+            )))
+        return position_id
+
+    def close(self, position_id: int) -> None:
+        with self._lock:
+            if position_id in self._positions:
+                self._positions[position_id]["status"] = "closed"
+
+    def get(self, position_id: int) -> Optional[Dict]:
+        position = self._positions.get(position_id)
+        return dict(position) if position else None
+
+    def list_active(self, user_ids: Sequence[str]) -> List[Dict]:
+        user_ids = set(user_ids)
+        with self._lock:
+            positions = [dict(p) for p in self._positions.values() if p["user_id"] in user_ids and p["status"] == "active"]
+        result = []
+        for position in positions:
+            wallet = self.wallets.get(position["user_id"])
+            if wallet:
+                result.append(dict(position, wallet_address=wallet[0]))
+        return result
+
+    def active_user_ids(self) -> List[str]:
+        with self._lock:
+            return sorted({p["user_id"] for p in self._positions.values() if p["status"] == "active"})
+
+
+class DictCreditRepository(CreditRepository):
+    def __init__(self):
+        self._credits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> int:
+        return self._credits.get(user_id, 0)
+
+    def deduct(self, user_id: str, amount: int) -> bool:
+        with self._lock:
+            if self._credits.get(user_id, 0) < amount:
+                return False
+            self._credits[user_id] -= amount
+            return True
+
+    def add(self, user_id: str, amount: int) -> None:
+        with self._lock:
+            self._credits[user_id] = self._credits.get(user_id, 0) + amount
+
+
+class Storage:
+    """Các repository và database SQL dùng chung cho một backend lưu trữ.
+
+    - "sqlite": file SQLite trong `data_dir()` (mặc định, bền vững).
+    - "memory": SQLite in-memory shared cache, cùng lược đồ, cho test và benchmark.
+    - "dict": wallets, positions và credits nằm trong dict của process; các bảng cần SQL
+      (outbox, snapshot, lease) dùng SQLite in-memory.
+
+    `db` là database "wallets" chứa outbox, snapshot và lease. Database in-memory nằm trong
+    `namespace` riêng của Storage (mặc định ngẫu nhiên) nên hai Storage không dùng chung bảng;
+    `close` giải phóng chúng.
+    """
+
+    def __init__(self, backend: str = "sqlite", namespace: Optional[str] = None):
+        if backend not in STORAGE_BACKENDS:
+            raise ValueError(f"Unsupported storage backend: {backend}")
+        self.backend = backend
+        self.namespace = "" if backend == "sqlite" else namespace or uuid.uuid4().hex[:12]
+        self._databases: List[Database] = []
+        self.db = self.database("wallets.db", schema="wallets")
+        if backend == "dict":
+            self.wallets = DictWalletRepository()
+            self.positions = DictPositionRepository(self.wallets)
+            self.credits = DictCreditRepository()
+        else:
+            self.wallets = SQLiteWalletRepository(self.db)
+            self.positions = SQLitePositionRepository(self.db)
+            self.credits = SQLiteCreditRepository(self.database("credits.db", schema="credits"))
+        logger.info(f"Storage backend: {backend}" + (f" (namespace {self.namespace})" if self.namespace else ""))
+
+    def database(self, db_name: str, schema: str) -> Database:
+        """Database cùng backend và namespace với Storage, được đóng cùng Storage."""
+        db = Database(db_name, schema=schema, backend="sqlite" if self.backend == "sqlite" else "memory",
+                      namespace=self.namespace)
+        self._databases.append(db)
+        return db
+
+    def close(self) -> None:
+        """Đóng các database của Storage; dữ liệu in-memory bị xóa."""
+        for db in self._databases:
+            db.close()
+        self._databases = []
+
+    def commit(self, statements: List[tuple], operations: Sequence[Tuple[object, str, tuple]] = (),
+               guard: Optional[tuple] = None) -> bool:
+        """Ghi câu lệnh SQL trên `db` cùng các thao tác repository (repository, tên method, tham số).
+
+        Với repository SQLite, tất cả chạy trong một transaction. Với backend dict, thao tác
+        repository được áp dụng sau khi SQL đã commit; dữ liệu dict mất khi process dừng nên
+        không cần bảo đảm nguyên tử giữa hai nơi lưu. Nếu `guard` không khớp đúng một dòng thì
+        không ghi gì và trả về False (xem `Database.execute_batch`).
+        """
+        if self.backend == "dict":
+            if not self.db.execute_batch(statements, guard):
+                return False
+            for repository, method, args in operations:
+                getattr(repository, method)(*args)
+            return True
+        for repository, method, args in operations:
+            statements = statements + getattr(repository, f"{method}_statements")(*args)
+        return self.db.execute_batch(statements, guard)
+
+
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    """Storage dùng chung của process, backend chọn bằng STORAGE_BACKEND (mặc định "sqlite")."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = Storage(os.getenv("STORAGE_BACKEND", "sqlite"))
+        return _storage
+
+
+def reset_storage() -> None:
+    """Đóng Storage dùng chung; lần gọi `get_storage` sau tạo Storage mới (dùng cho test/benchmark)."""
+    global _storage
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+            _storage = None
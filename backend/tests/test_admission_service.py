@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission_service import AdmissionRejected, DependencyLimiter  # noqa: E402
+
+
+def test_async_waiters_are_served_in_order():
+    limiter = DependencyLimiter("bundler", max_concurrent=1, max_queue=10, max_wait=5.0)
+    order = []
+
+    async def call(i):
+        async with limiter.slot_async():
+            order.append(i)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        tasks = []
+        for i in range(5):
+            tasks.append(asyncio.create_task(call(i)))
+            await asyncio.sleep(0)  # Bảo đảm thứ tự đến
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(main())
+    assert order == [0, 1, 2, 3, 4]
+    assert elapsed < 0.5
+    assert limiter.active == 0 and limiter.waiting == 0
+
+
+def test_release_from_thread_wakes_async_waiter():
+    limiter = DependencyLimiter("rpc", max_concurrent=1, max_queue=10, max_wait=5.0)
+    limiter.acquire()
+
+    async def main():
+        threading.Timer(0.05, limiter.release).start()
+        await limiter.acquire_async()
+        limiter.release()
+
+    asyncio.run(main())
+    assert limiter.active == 0
+
+
+def test_queue_full_and_wait_timeout_are_rejected():
+    limiter = DependencyLimiter("kms", max_concurrent=1, max_queue=1, max_wait=0.05)
+    limiter.acquire()
+    errors = []
+
+    def wait():
+        try:
+            limiter.acquire()
+        except AdmissionRejected as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.01)
+    with pytest.raises(AdmissionRejected):
+        limiter.acquire()  # Hàng đợi đã đầy
+    waiter.join()
+    assert len(errors) == 1  # Chờ quá max_wait
+    assert limiter.waiting == 0
+    limiter.release()
+    assert limiter.active == 0
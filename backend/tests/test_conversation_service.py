@@ -0,0 +1,70 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_service import ConversationStore  # noqa: E402
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    db = Database("conversations.db", schema="conversations", backend="memory", namespace=uuid.uuid4().hex[:12])
+    yield db
+    db.close()
+
+
+def counting_store(db, **kwargs):
+    """ConversationStore đếm số lần nạp hội thoại từ DB."""
+    store = ConversationStore(db, **kwargs)
+    store.loads = 0
+    load = store._load
+
+    def counted(user_id):
+        store.loads += 1
+        return load(user_id)
+
+    store._load = counted
+    return store
+
+
+def test_local_writes_are_served_from_cache(db):
+    store = counting_store(db, max_turns=4)
+    for i in range(5):
+        store.build_context("u")
+        store.record("u", f"q{i}", f"a{i}")
+    summary, turns = store.build_context("u")
+
+    assert store.loads == 1
+    assert [t["content"] for t in turns] == ["q3", "a3", "q4", "a4"]
+    assert "q2" in summary
+    # Bản trong bộ nhớ khớp với bản nạp lại từ DB
+    fresh = ConversationStore(db, max_turns=4)
+    assert fresh.build_context("u") == (summary, turns)
+
+
+def test_write_from_other_worker_triggers_reload(db):
+    a, b = counting_store(db), counting_store(db)
+    a.record("u", "q1", "a1")
+    b.build_context("u")
+    a.record("u", "q2", "a2")
+
+    _, turns = b.build_context("u")
+    assert [t["content"] for t in turns] == ["q1", "a1", "q2", "a2"]
+    assert b.loads == 2
+
+    # Lượt của b ghi sau lượt của a mà a chưa thấy: a phải nạp lại
+    b.record("u", "q3", "a3")
+    _, turns = a.build_context("u")
+    assert [t["content"] for t in turns][-2:] == ["q3", "a3"]
+
+
+def test_clear_from_other_worker_drops_cached_turns(db):
+    a, b = ConversationStore(db), ConversationStore(db)
+    a.record("u", "q1", "a1")
+    b.build_context("u")
+    a.clear("u")
+    assert b.build_context("u") == ("", [])
@@ -0,0 +1,51 @@
+import logging
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("web3")
+
+from web3 import Web3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gas_oracle import DEFAULT_GAS_LIMITS, GasOracle  # noqa: E402
+
+CALL_DATA = "0xb61d27f6" + "00" * 100
+USER_OP = {"sender": "0x" + "11" * 20, "initCode": "0x", "callData": CALL_DATA}
+
+
+@pytest.fixture
+def oracle():
+    return GasOracle(Web3(), "http://bundler", "0x" + "22" * 20)
+
+
+def test_cold_start_uses_defaults(oracle):
+    assert oracle.get_fees() == (Web3.to_wei(2, "gwei"), Web3.to_wei(1, "gwei"))
+    assert oracle.get_gas_limits("supply", USER_OP) == DEFAULT_GAS_LIMITS
+
+
+def test_fresh_fees_are_used_unchanged(oracle):
+    oracle._fees = (1000, 10, time.time())
+    assert oracle.get_fees() == (1000, 10)
+
+
+def test_stale_fees_get_a_growing_safety_margin(oracle, caplog):
+    with caplog.at_level(logging.WARNING, logger="gas_oracle"):
+        oracle._fees = (1000, 10, time.time() - oracle.fee_ttl * 1.5)
+        assert oracle.get_fees() == (1500, 10)
+        oracle._fees = (1000, 10, time.time() - oracle.fee_ttl * 100)
+        assert oracle.get_fees() == (4000, 10)
+    # Một cảnh báo cho mỗi TTL, không phải mỗi lần đọc
+    assert len([r for r in caplog.records if "fees" in r.getMessage()]) == 1
+
+
+def test_stale_gas_estimates_get_a_safety_margin(oracle):
+    key = GasOracle.shape_key("supply", CALL_DATA)
+    estimate = {"callGasLimit": 100000, "verificationGasLimit": 80000, "preVerificationGas": 40000}
+    oracle._estimates[key] = (estimate, time.time())
+    assert oracle.get_gas_limits("supply", USER_OP) == estimate
+    oracle._estimates[key] = (estimate, time.time() - oracle.estimate_ttl * 1.5)
+    assert oracle.get_gas_limits("supply", USER_OP) == {name: int(value * 1.25) for name, value in estimate.items()}
@@ -0,0 +1,74 @@
+import glob
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("pandas")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_service import DAY_SECONDS, HistoryStore  # noqa: E402
+from lease_service import shard_for  # noqa: E402
+
+USERS = [f"user{i}" for i in range(8)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path), num_shards=4)
+
+
+def day_start(days_ago: int) -> int:
+    return (int(time.time()) // DAY_SECONDS - days_ago) * DAY_SECONDS
+
+
+def append_sweeps(store, start, sweeps, step=900):
+    for k in range(sweeps):
+        for i, user_id in enumerate(USERS):
+            store.append(start + k * step, user_id, i, "aave" if i % 2 else "uniswap", 100.0 + k, 1.0 + k / 1000)
+        store.flush()
+
+
+def test_query_reads_buffer_without_flushing(store):
+    store.append(day_start(0) + 60, "user0", 0, "aave", 100.0, 1.0)
+    frame = store.query(user_id="user0")
+    assert frame["position_id"].tolist() == [0]
+    assert len(store._buffer) == 1
+    assert not glob.glob(os.path.join(store.root_dir, "**", "*.npz"), recursive=True)
+
+
+def test_user_query_reads_only_its_shard(store):
+    append_sweeps(store, day_start(0), 3)
+    shard = str(shard_for("user3", store.num_shards))
+    segments = store._segments("raw", None, None, "user3")
+    assert segments and all(os.path.basename(os.path.dirname(path)) == shard for path in segments)
+    assert len(segments) < len(store._segments("raw", None, None))
+
+    frame = store.query(user_id="user3")
+    assert set(frame["user_id"]) == {"user3"}
+    assert frame["ts"].tolist() == sorted(frame["ts"].tolist()) and len(frame) == 3
+
+
+def test_compact_merges_finished_days_and_rebuilds_late_rollups(store):
+    start = day_start(2)
+    append_sweeps(store, start, 8)
+    before = store.query()
+    store.compact()
+
+    for shard_dir in glob.glob(os.path.join(store.root_dir, "raw", str(start // DAY_SECONDS), "*")):
+        assert len(store._files(shard_dir)) == 1
+    after = store.query()
+    assert after.equals(before)
+    hourly = store.query(user_id="user1", resolution="1h")
+    assert hourly["ts"].tolist() == [start, start + 3600]
+
+    # Mẫu đến trễ cho ngày đã rollup
+    time.sleep(0.01)
+    store.append(start + 5 * 3600, "user1", 1, "aave", 150.0, 1.5)
+    store.flush()
+    store.compact()
+    hourly = store.query(user_id="user1", resolution="1h")
+    assert hourly["ts"].tolist() == [start, start + 3600, start + 5 * 3600]
+    assert hourly["profit_ratio"].iloc[-1] == 1.5
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("defi_service")
+
+from outbox_service import OutboxService  # noqa: E402
+from repositories import Storage  # noqa: E402
+
+
+class StubDeFiService:
+    """DeFiService giả: user operation là dict, bundler và EntryPoint nằm trong bộ nhớ."""
+
+    uniswap_router = "0x" + "11" * 20
+    ai_wallet_address = "0x" + "22" * 20
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.db = storage.db
+        self.onchain_nonces = {}
+        self.sent = []
+        self.send_errors = 0
+        self.on_send = None
+
+    def get_wallet(self, user_id):
+        return self.storage.wallets.get(user_id) or (None, 0)
+
+    def create_user_op(self, wallet_address, action_type, amount, nonce, recipient=None):
+        return {"sender": wallet_address, "action_type": action_type, "amount": amount, "nonce": nonce}
+
+    def sign_user_op(self, user_op):
+        return dict(user_op, signature="0xsig")
+
+    def get_onchain_nonce(self, wallet_address):
+        return self.onchain_nonces.get(wallet_address, 0)
+
+    async def send_user_op_async(self, user_op, user_id):
+        if self.on_send:
+            on_send, self.on_send = self.on_send, None
+            await on_send()
+        if self.send_errors:
+            self.send_errors -= 1
+            raise Exception("bundler unavailable")
+        self.sent.append(user_op)
+        return {"result": f"0xop{len(self.sent)}"}
+
+
+@pytest.fixture
+def storage():
+    storage = Storage("memory")
+    for user_id in ("alice", "bob"):
+        storage.wallets.save(user_id, f"0x{user_id}")
+    yield storage
+    storage.close()
+
+
+@pytest.fixture
+def defi(storage):
+    return StubDeFiService(storage)
+
+
+@pytest.fixture
+def outbox(defi):
+    return OutboxService(defi, max_attempts=2)
+
+
+def run_next(outbox):
+    job = outbox._claim_job()
+    if job:
+        asyncio.run(outbox._run_job(job))
+    return job
+
+
+def status(outbox, job_id):
+    return outbox.get_job(job_id)["status"]
+
+
+def make_ready(outbox):
+    outbox.db.update("UPDATE outbox_jobs SET next_attempt_at = 0 WHERE status = 'pending'")
+
+
+def test_jobs_of_one_wallet_run_in_order(outbox):
+    first = outbox.enqueue_supply("alice", 10)["job_id"]
+    second = outbox.enqueue_supply("alice", 20)["job_id"]
+    other = outbox.enqueue_supply("bob", 30)["job_id"]
+
+    claimed = outbox._claim_job()
+    assert claimed["job_id"] == first
+    # alice còn job đang chạy: job sau của alice phải chờ, ví khác vẫn chạy được
+    assert outbox._claim_job()["job_id"] == other
+    assert outbox._claim_job() is None
+    asyncio.run(outbox._run_job(claimed))
+    assert run_next(outbox)["job_id"] == second
+    assert [status(outbox, job_id) for job_id in (first, second)] == ["done", "done"]
+
+
+def test_idempotency_key_dedups_and_is_released_on_failure(outbox, defi, storage):
+    job_id = outbox.enqueue_supply("alice", 10, idempotency_key="k1")["job_id"]
+    assert outbox.enqueue_supply("alice", 10, idempotency_key="k1")["job_id"] == job_id
+
+    defi.send_errors = 2
+    run_next(outbox)
+    assert status(outbox, job_id) == "pending"
+    make_ready(outbox)
+    run_next(outbox)
+    assert status(outbox, job_id) == "failed"
+
+    retried = outbox.enqueue_supply("alice", 10, idempotency_key="k1")["job_id"]
+    assert retried != job_id
+    run_next(outbox)
+    assert status(outbox, retried) == "done"
+    assert len(storage.positions.list_active(["alice"])) == 1
+
+
+def test_stale_worker_completion_is_dropped(outbox, defi, storage):
+    job_id = outbox.enqueue_supply("alice", 10)["job_id"]
+    stale = outbox._claim_job()
+
+    async def lease_expires_and_job_is_reclaimed():
+        outbox.db.update("UPDATE outbox_jobs SET locked_until = 0 WHERE job_id = ?", (job_id,))
+        await outbox._run_job(outbox._claim_job())
+
+    defi.on_send = lease_expires_and_job_is_reclaimed
+    asyncio.run(outbox._run_job(stale))
+
+    assert status(outbox, job_id) == "done"
+    assert len(storage.positions.list_active(["alice"])) == 1
+    assert outbox.get_job(job_id)["user_op_hashes"] == ["0xop1"]
+    assert storage.wallets.get("alice") == ("0xalice", 1)
+
+
+def test_signed_op_is_resent_after_failure(outbox, defi, storage):
+    job_id = outbox.enqueue_supply("alice", 10)["job_id"]
+    defi.send_errors = 1
+    run_next(outbox)
+    signed_op = json.loads(outbox.db.fetch_one("SELECT signed_op FROM outbox_jobs WHERE job_id = ?", (job_id,))[0])
+
+    make_ready(outbox)
+    run_next(outbox)
+    assert defi.sent == [signed_op]
+    assert status(outbox, job_id) == "done"
+
+
+def test_included_signed_op_is_not_resent(outbox, defi, storage):
+    job_id = outbox.enqueue_supply("alice", 10)["job_id"]
+    defi.send_errors = 1
+    run_next(outbox)
+    # Op đã lên chain dù bundler báo lỗi
+    defi.onchain_nonces["0xalice"] = 1
+
+    make_ready(outbox)
+    run_next(outbox)
+    assert defi.sent == []
+    assert outbox.get_job(job_id)["user_op_hashes"] == ["included"]
+    assert storage.wallets.get("alice") == ("0xalice", 1)
+
+
+def test_new_ops_use_onchain_nonce_when_db_nonce_lags(outbox, defi, storage):
+    defi.onchain_nonces["0xalice"] = 5
+    outbox.enqueue_swap("alice", 10)
+    run_next(outbox)
+    assert [op["nonce"] for op in defi.sent] == [5, 6]
+    assert storage.wallets.get("alice") == ("0xalice", 7)
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repositories import STORAGE_BACKENDS, Storage  # noqa: E402
+
+
+@pytest.fixture(params=STORAGE_BACKENDS)
+def storage(request, tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    storage = Storage(request.param)
+    yield storage
+    storage.close()
+
+
+def test_wallet_nonce_only_moves_forward(storage):
+    assert storage.wallets.get("alice") is None
+    storage.wallets.save("alice", "0xalice")
+    storage.wallets.bump_nonce("alice", 3)
+    storage.wallets.bump_nonce("alice", 2)
+    assert storage.wallets.get("alice") == ("0xalice", 3)
+    storage.wallets.bump_nonce("nobody", 1)
+    assert storage.wallets.get("nobody") is None
+
+
+def test_deduct_requires_enough_credits(storage):
+    assert storage.credits.get("alice") == 0
+    assert not storage.credits.deduct("alice", 1)
+    storage.credits.add("alice", 5)
+    storage.credits.add("alice", 5)
+    assert storage.credits.deduct("alice", 7)
+    assert not storage.credits.deduct("alice", 4)
+    assert storage.credits.get("alice") == 3
+
+
+def test_list_active_joins_wallet_address(storage):
+    storage.wallets.save("alice", "0xalice")
+    storage.wallets.save("bob", "0xbob")
+    aave = storage.positions.open("alice", "aave", 100.0, 100.0, 1, entry_index="10")
+    uniswap = storage.positions.open("alice", "uniswap", 50.0, 50.0, 2, entry_sqrt_price_x96="20")
+    storage.positions.open("bob", "aave", 10.0, 10.0, 3)
+    storage.positions.open("carol", "aave", 10.0, 10.0, 4)  # Không có ví: không được trả về
+    storage.positions.close(uniswap)
+
+    active = storage.positions.list_active(["alice", "carol"])
+    assert [(p["position_id"], p["wallet_address"], p["entry_index"]) for p in active] == [(aave, "0xalice", "10")]
+    assert storage.positions.get(uniswap)["status"] == "closed"
+    assert storage.positions.get(uniswap)["entry_sqrt_price_x96"] == "20"
+    assert storage.positions.get(999) is None
+    assert set(storage.positions.active_user_ids()) == {"alice", "bob", "carol"}
+    assert storage.positions.list_active([]) == []
+
+
+def test_commit_applies_statements_and_operations_together(storage):
+    storage.wallets.save("alice", "0xalice")
+    storage.db.execute("INSERT INTO leases (name, owner, expires_at) VALUES ('job', 'worker-1', 0)")
+    statement = [("UPDATE leases SET expires_at = 1 WHERE name = 'job'", ())]
+    operations = [(storage.wallets, "bump_nonce", ("alice", 4)),
+                  (storage.positions, "open", ("alice", "aave", 10.0, 10.0, 1))]
+
+    rejected = ("UPDATE leases SET owner = 'worker-2' WHERE name = 'job' AND owner = 'worker-3'", ())
+    assert not storage.commit(statement, operations, rejected)
+    assert storage.db.fetch_one("SELECT owner, expires_at FROM leases") == ("worker-1", 0)
+    assert storage.wallets.get("alice") == ("0xalice", 0)
+    assert storage.positions.list_active(["alice"]) == []
+
+    accepted = ("UPDATE leases SET owner = 'worker-2' WHERE name = 'job' AND owner = 'worker-1'", ())
+    assert storage.commit(statement, operations, accepted)
+    assert storage.db.fetch_one("SELECT owner, expires_at FROM leases") == ("worker-2", 1)
+    assert storage.wallets.get("alice") == ("0xalice", 4)
+    assert len(storage.positions.list_active(["alice"])) == 1
+
+
+def test_memory_storages_do_not_share_tables(storage):
+    storage.db.execute("INSERT INTO leases (name, owner, expires_at) VALUES ('job', 'worker-1', 0)")
+    other = Storage(storage.backend)
+    try:
+        expected = 1 if storage.backend == "sqlite" else 0
+        assert other.db.fetch_one("SELECT COUNT(*) FROM leases")[0] == expected
+    finally:
+        other.close()
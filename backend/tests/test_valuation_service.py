@@ -0,0 +1,139 @@
+import math
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("web3")
+
+from eth_abi import decode, encode
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from valuation_service import Q96, ValuationService  # noqa: E402
+
+USDC = Web3.to_checksum_address("0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913")
+WETH = Web3.to_checksum_address("0x4200000000000000000000000000000000000006")
+AAVE_POOL = Web3.to_checksum_address("0x" + "a1" * 20)
+MULTICALL = Web3.to_checksum_address("0x" + "b1" * 20)
+AUSDC = Web3.to_checksum_address("0x" + "b2" * 20)
+FACTORY = Web3.to_checksum_address("0x" + "b3" * 20)
+QUOTER = Web3.to_checksum_address("0x" + "b4" * 20)
+POOL = Web3.to_checksum_address("0x" + "c1" * 20)
+WALLET_A = Web3.to_checksum_address("0x" + "d1" * 20)
+WALLET_B = Web3.to_checksum_address("0x" + "d2" * 20)
+
+RAY = 10 ** 27
+LIQUIDITY_INDEX = 105 * RAY // 100
+# WETH là token0 nên giá thô = (sqrtPriceX96 / Q96)^2 đơn vị USDC nhỏ nhất trên wei: 3000 USDC/ETH
+SQRT_PRICE_X96 = int(math.sqrt(3000 * 10 ** 6 / 10 ** 18) * Q96)
+QUOTE_USDC_PER_ETH = 2990  # Giá thoát thấp hơn spot do price impact
+
+
+def selector(signature: str) -> bytes:
+    return bytes(Web3.keccak(text=signature)[:4])
+
+
+class FakeNode(BaseProvider):
+    """Node JSON-RPC giả: trả lời eth_call cho Multicall3, Aave, Uniswap và ERC20."""
+
+    def __init__(self, balances):
+        super().__init__()
+        self.balances = balances  # {(token, wallet): số dư}
+        self.aggregate_calls = []
+
+    def _call(self, target: str, data: bytes) -> bytes:
+        target, fn, args = Web3.to_checksum_address(target), data[:4], data[4:]
+        if target == MULTICALL and fn == selector("aggregate3((address,bool,bytes)[])"):
+            calls, = decode(["(address,bool,bytes)[]"], args)
+            self.aggregate_calls.append(calls)
+            results = []
+            for sub_target, _, call_data in calls:
+                try:
+                    results.append((True, self._call(sub_target, call_data)))
+                except KeyError:
+                    results.append((False, b""))
+            return encode(["(bool,bytes)[]"], [results])
+        if target == FACTORY and fn == selector("getPool(address,address,uint24)"):
+            return encode(["address"], [POOL])
+        if target == AAVE_POOL and fn == selector("getReserveNormalizedIncome(address)"):
+            return encode(["uint256"], [LIQUIDITY_INDEX])
+        if target == POOL and fn == selector("slot0()"):
+            return encode(["uint160", "int24", "uint16", "uint16", "uint16", "uint8", "bool"],
+                          [SQRT_PRICE_X96, 0, 0, 1, 1, 0, True])
+        if target == QUOTER and fn == selector("quoteExactInputSingle((address,address,uint256,uint24,uint160))"):
+            (_, _, amount_in, _, _), = decode(["(address,address,uint256,uint24,uint160)"], args)
+            return encode(["uint256", "uint160", "uint32", "uint256"],
+                          [amount_in * QUOTE_USDC_PER_ETH * 10 ** 6 // 10 ** 18, SQRT_PRICE_X96, 1, 100000])
+        if fn == selector("balanceOf(address)"):
+            wallet, = decode(["address"], args)
+            return encode(["uint256"], [self.balances[(target, Web3.to_checksum_address(wallet))]])
+        raise KeyError((target, fn.hex()))
+
+    def make_request(self, method, params):
+        if method == "eth_chainId":
+            result = hex(8453)
+        elif method == "net_version":
+            result = "8453"
+        elif method == "eth_blockNumber":
+            result = hex(1000)
+        elif method == "eth_call":
+            transaction = params[0]
+            result = "0x" + self._call(transaction["to"], bytes.fromhex(transaction["data"][2:])).hex()
+        else:
+            raise NotImplementedError(method)
+        return {"jsonrpc": "2.0", "id": 1, "result": result}
+
+
+@pytest.fixture
+def node():
+    return FakeNode({(AUSDC, WALLET_A): 0, (WETH, WALLET_A): 0, (AUSDC, WALLET_B): 80 * 10 ** 6,
+                     (WETH, WALLET_B): 10 ** 17})
+
+
+@pytest.fixture
+def service(node):
+    return ValuationService(Web3(node), USDC, WETH, AAVE_POOL, multicall_address=MULTICALL, ausdc_address=AUSDC,
+                            uniswap_factory=FACTORY, uniswap_quoter=QUOTER)
+
+
+def position(position_id, wallet, platform, initial_amount, entry_index=None, entry_sqrt_price_x96=None):
+    return {"position_id": position_id, "wallet_address": wallet, "platform": platform, "initial_amount": initial_amount,
+            "entry_index": entry_index, "entry_sqrt_price_x96": entry_sqrt_price_x96}
+
+
+def test_entry_marks(service):
+    assert service.get_entry_marks() == {"entry_index": str(LIQUIDITY_INDEX), "entry_sqrt_price_x96": str(SQRT_PRICE_X96)}
+
+
+def test_value_positions_in_two_multicall_rounds(node, service):
+    positions = [
+        position(1, WALLET_A, "aave", 100.0, entry_index=str(RAY)),
+        position(2, WALLET_A, "uniswap", 300.0, entry_sqrt_price_x96=str(SQRT_PRICE_X96)),
+        # Vị thế cũ chưa có mốc: chia số dư của ví theo vốn ban đầu
+        position(3, WALLET_B, "aave", 30.0),
+        position(4, WALLET_B, "aave", 10.0),
+        position(5, WALLET_B, "uniswap", 500.0),
+    ]
+    values = service.value_positions(positions)
+
+    assert len(node.aggregate_calls) == 2
+    round1, round2 = node.aggregate_calls
+    assert len(round1) == 2 + 2 * 2  # index, slot0 và hai số dư cho mỗi ví
+    assert len(round2) == 2  # một quote cho mỗi vị thế Uniswap
+    assert {Web3.to_checksum_address(target) for target, _, _ in round2} == {QUOTER}
+
+    assert values[1] == pytest.approx(105.0)
+    assert values[2] == pytest.approx(300.0 * QUOTE_USDC_PER_ETH / 3000, rel=1e-6)
+    assert values[3] == pytest.approx(60.0)
+    assert values[4] == pytest.approx(20.0)
+    assert values[5] == pytest.approx(0.1 * QUOTE_USDC_PER_ETH, rel=1e-6)
+
+
+def test_same_block_reuses_cached_results(node, service):
+    positions = [position(1, WALLET_A, "aave", 100.0, entry_index=str(RAY))]
+    service.value_positions(positions)
+    service.value_positions(positions)
+    assert len(node.aggregate_calls) == 1
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from web3 import Web3
+
+from admission_service import admission
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MULTICALL3_ADDRESS = Web3.to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+AAVE_AUSDC_ADDRESS = Web3.to_checksum_address("0x4e65fE4DbA92790696d040ac24Aa414708F5c0AB")
+UNISWAP_FACTORY_ADDRESS = Web3.to_checksum_address("0x33128a8fC17869897dcE68Ed026d694621f6FDfD")
+UNISWAP_QUOTER_ADDRESS = Web3.to_checksum_address("0x3d4e44Eb1374240CE5F1B871ab261CD16335B76a")
+UNISWAP_POOL_FEE = 3000  # Cùng fee tier với swap trong DeFiService.create_user_op
+
+USDC_DECIMALS = 6
+Q96 = 2 ** 96
+
+
+class ValuationService:
+    """Định giá vị thế bằng dữ liệu on-chain, gom mọi lệnh đọc vào Multicall3.
+
+    Một lượt định giá gồm hai vòng `aggregate3`: vòng 1 đọc liquidity index của Aave,
+    slot0 của pool Uniswap và số dư aToken/WETH của từng ví; vòng 2 gọi Quoter cho
+    lượng WETH của từng vị thế Uniswap. Mỗi vòng được chia chunk và chạy song song,
+    kết quả được cache theo block nên số `eth_call` không phụ thuộc số vị thế.
+    Địa chỉ hợp đồng mặc định là của Base, có thể thay để chạy trên node khác (fork, node giả).
+    """
+
+    def __init__(self, w3: Web3, usdc_address: str, weth_address: str, aave_pool: str,
+                 chunk_size: int = 200, max_parallel: int = 4, multicall_address: str = MULTICALL3_ADDRESS,
+                 ausdc_address: str = AAVE_AUSDC_ADDRESS, uniswap_factory: str = UNISWAP_FACTORY_ADDRESS,
+                 uniswap_quoter: str = UNISWAP_QUOTER_ADDRESS, pool_fee: int = UNISWAP_POOL_FEE):
+        self.w3 = w3
+        self.usdc_address = Web3.to_checksum_address(usdc_address)
+        self.weth_address = Web3.to_checksum_address(weth_address)
+        self.aave_pool = Web3.to_checksum_address(aave_pool)
+        self.ausdc_address = Web3.to_checksum_address(ausdc_address)
+        self.quoter_address = Web3.to_checksum_address(uniswap_quoter)
+        self.pool_fee = pool_fee
+        self.chunk_size = chunk_size
+        self.max_parallel = max_parallel
+        self._lock = threading.Lock()
+        self._cache_block: Optional[int] = None
+        self._cache: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._uniswap_pool: Optional[str] = None
+
+        self.multicall = w3.eth.contract(address=Web3.to_checksum_address(multicall_address), abi=json.loads('''[
+            {"inputs":[{"components":[{"internalType":"address","name":"target","type":"address"},{"internalType":"bool","name":"allowFailure","type":"bool"},{"internalType":"bytes","name":"callData","type":"bytes"}],"internalType":"struct Multicall3.Call3[]","name":"calls","type":"tuple[]"}],"name":"aggregate3","outputs":[{"components":[{"internalType":"bool","name":"success","type":"bool"},{"internalType":"bytes","name":"returnData","type":"bytes"}],"internalType":"struct Multicall3.Result[]","name":"returnData","type":"tuple[]"}],"stateMutability":"payable","type":"function"}
+        ]'''))
+        self.erc20 = w3.eth.contract(abi=json.loads('''[
+            {"constant":true,"inputs":[{"name":"account","type":"address"}],"name":"balanceOf","outputs":[{"name":"","type":"uint256"}],"type":"function"}
+        ]'''))
+        self.aave = w3.eth.contract(abi=json.loads('''[
+            {"inputs":[{"internalType":"address","name":"asset","type":"address"}],"name":"getReserveNormalizedIncome","outputs":[{"internalType":"uint256","name":"","type":"uint256"}],"stateMutability":"view","type":"function"}
+        ]'''))
+        self.uniswap_factory = w3.eth.contract(address=Web3.to_checksum_address(uniswap_factory), abi=json.loads('''[
+            {"inputs":[{"internalType":"address","name":"tokenA","type":"address"},{"internalType":"address","name":"tokenB","type":"address"},{"internalType":"uint24","name":"fee","type":"uint24"}],"name":"getPool","outputs":[{"internalType":"address","name":"pool","type":"address"}],"stateMutability":"view","type":"function"}
+        ]'''))
+        self.uniswap_pool = w3.eth.contract(abi=json.loads('''[
+            {"inputs":[],"name":"slot0","outputs":[{"internalType":"uint160","name":"sqrtPriceX96","type":"uint160"},{"internalType":"int24","name":"tick","type":"int24"},{"internalType":"uint16","name":"observationIndex","type":"uint16"},{"internalType":"uint16","name":"observationCardinality","type":"uint16"},{"internalType":"uint16","name":"observationCardinalityNext","type":"uint16"},{"internalType":"uint8","name":"feeProtocol","type":"uint8"},{"internalType":"bool","name":"unlocked","type":"bool"}],"stateMutability":"view","type":"function"}
+        ]'''))
+        self.quoter = w3.eth.contract(abi=json.loads('''[
+            {"inputs":[{"components":[{"internalType":"address","name":"tokenIn","type":"address"},{"internalType":"address","name":"tokenOut","type":"address"},{"internalType":"uint256","name":"amountIn","type":"uint256"},{"internalType":"uint24","name":"fee","type":"uint24"},{"internalType":"uint160","name":"sqrtPriceLimitX96","type":"uint160"}],"internalType":"struct IQuoterV2.QuoteExactInputSingleParams","name":"params","type":"tuple"}],"name":"quoteExactInputSingle","outputs":[{"internalType":"uint256","name":"amountOut","type":"uint256"},{"internalType":"uint160","name":"sqrtPriceX96After","type":"uint160"},{"internalType":"uint32","name":"initializedTicksCrossed","type":"uint32"},{"internalType":"uint256","name":"gasEstimate","type":"uint256"}],"stateMutability":"nonpayable","type":"function"}
+        ]'''))
+
+    def _get_uniswap_pool(self) -> str:
+        if not self._uniswap_pool:
+            self._uniswap_pool = self.uniswap_factory.functions.getPool(self.usdc_address, self.weth_address, self.pool_fee).call()
+        return self._uniswap_pool
+
+    def _multicall(self, calls: List[Tuple[str, str]], block: int) -> Dict[Tuple[str, str], Optional[bytes]]:
+        """Thực thi các lệnh (target, calldata) qua aggregate3, có cache theo block."""
+        with self._lock:
+            if self._cache_block != block:
+                self._cache_block, self._cache = block, {}
+            results = {call: self._cache[call] for call in calls if call in self._cache}
+        pending = list(dict.fromkeys(call for call in calls if call not in results))
+        chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+
+        def run_chunk(chunk):
+            encoded = [(target, True, call_data) for target, call_data in chunk]
+            with admission.dependency("rpc").slot():
+                return self.multicall.functions.aggregate3(encoded).call(block_identifier=block)
+
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(chunks))) as executor:
+                for chunk, returned in zip(chunks, executor.map(run_chunk, chunks)):
+                    for call, (success, data) in zip(chunk, returned):
+                        results[call] = bytes(data) if success else None
+            with self._lock:
+                if self._cache_block == block:
+                    self._cache.update({call: results[call] for call in pending})
+        return results
+
+    def _decode_uint(self, data: Optional[bytes]) -> Optional[int]:
+        return self.w3.codec.decode(["uint256"], data)[0] if data else None
+
+    def _mark_calls(self) -> Tuple[Tuple[str, str], Tuple[str, str]]:
+        """Lệnh đọc liquidity index của USDC trên Aave và slot0 của pool USDC/WETH."""
+        index_call = (self.aave_pool, self.aave.encodeABI(fn_name="getReserveNormalizedIncome", args=[self.usdc_address]))
+        slot0_call = (self._get_uniswap_pool(), self.uniswap_pool.encodeABI(fn_name="slot0"))
+        return index_call, slot0_call
+
+    def get_entry_marks(self) -> Dict[str, Optional[str]]:
+        """Đọc liquidity index Aave và sqrtPriceX96 của pool để lưu khi mở vị thế."""
+        block = self.w3.eth.block_number
+        index_call, slot0_call = self._mark_calls()
+        results = self._multicall([index_call, slot0_call], block)
+        liquidity_index = self._decode_uint(results[index_call])
+        sqrt_price = self._decode_uint(results[slot0_call][:32]) if results[slot0_call] else None
+        return {
+            "entry_index": str(liquidity_index) if liquidity_index else None,
+            "entry_sqrt_price_x96": str(sqrt_price) if sqrt_price else None
+        }
+
+    def _usdc_per_weth_raw(self, sqrt_price_x96: int) -> float:
+        """Giá thô (đơn vị nhỏ nhất USDC / đơn vị nhỏ nhất WETH) từ sqrtPriceX96."""
+        price = (sqrt_price_x96 / Q96) ** 2  # token1 trên token0
+        weth_is_token0 = int(self.weth_address, 16) < int(self.usdc_address, 16)
+        return price if weth_is_token0 else 1 / price
+
+    def value_positions(self, positions: List[Dict]) -> Dict[int, float]:
+        """Định giá USD cho các vị thế active.
+
+        Mỗi vị thế gồm position_id, wallet_address, platform, initial_amount, entry_index và
+        entry_sqrt_price_x96. Vị thế có mốc lúc mở được định giá theo tỉ lệ index/giá;
+        vị thế cũ chưa có mốc được chia số dư aToken/WETH của ví theo tỉ lệ vốn ban đầu.
+        """
+        if not positions:
+            return {}
+        block = self.w3.eth.block_number
+        index_call, slot0_call = self._mark_calls()
+
+        # Vòng 1: index, slot0 và số dư của từng ví
+        calls = [index_call, slot0_call]
+        wallets = {Web3.to_checksum_address(p["wallet_address"]) for p in positions}
+        balance_calls = {}
+        for wallet in wallets:
+            data = self.erc20.encodeABI(fn_name="balanceOf", args=[wallet])
+            balance_calls[wallet] = {"aave": (self.ausdc_address, data), "uniswap": (self.weth_address, data)}
+            calls += balance_calls[wallet].values()
+        results = self._multicall(calls, block)
+
+        liquidity_index = self._decode_uint(results[index_call])
+        sqrt_price = self._decode_uint(results[slot0_call][:32]) if results[slot0_call] else None
+
+        # Tổng vốn ban đầu của các vị thế cũ theo (ví, platform) để chia số dư
+        legacy_totals: Dict[Tuple[str, str], float] = {}
+        for p in positions:
+            entry = p.get("entry_index") if p["platform"] == "aave" else p.get("entry_sqrt_price_x96")
+            if not entry:
+                key = (Web3.to_checksum_address(p["wallet_address"]), p["platform"])
+                legacy_totals[key] = legacy_totals.get(key, 0.0) + p["initial_amount"]
+
+        values: Dict[int, float] = {}
+        weth_amounts: Dict[int, int] = {}
+        for p in positions:
+            wallet = Web3.to_checksum_address(p["wallet_address"])
+            platform = p["platform"]
+            balance = self._decode_uint(results[balance_calls[wallet][platform]]) if platform in ("aave", "uniswap") else None
+            if platform == "aave":
+                if p.get("entry_index") and liquidity_index:
+                    values[p["position_id"]] = p["initial_amount"] * liquidity_index / int(p["entry_index"])
+                elif balance is not None:
+                    share = p["initial_amount"] / legacy_totals[(wallet, platform)]
+                    values[p["position_id"]] = balance * share / 10 ** USDC_DECIMALS
+            elif platform == "uniswap":
+                if p.get("entry_sqrt_price_x96"):
+                    entry_price = self._usdc_per_weth_raw(int(p["entry_sqrt_price_x96"]))
+                    weth_amounts[p["position_id"]] = int(p["initial_amount"] * 10 ** USDC_DECIMALS / entry_price)
+                elif balance is not None:
+                    share = p["initial_amount"] / legacy_totals[(wallet, platform)]
+                    weth_amounts[p["position_id"]] = int(balance * share)
+
+        # Vòng 2: giá trị thoát WETH -> USDC qua Quoter (tính cả price impact)
+        quote_calls = {
+            position_id: (self.quoter_address, self.quoter.encodeABI(fn_name="quoteExactInputSingle", args=[(
+                self.weth_address, self.usdc_address, amount, self.pool_fee, 0
+            )]))
+            for position_id, amount in weth_amounts.items() if amount > 0
+        }
+        quotes = self._multicall(list(quote_calls.values()), block) if quote_calls else {}
+        for position_id, amount in weth_amounts.items():
+            amount_out = self._decode_uint(quotes[quote_calls[position_id]][:32]) if amount > 0 and quotes.get(quote_calls[position_id]) else None
+            if amount_out is not None:
+                values[position_id] = amount_out / 10 ** USDC_DECIMALS
+            elif amount == 0:
+                values[position_id] = 0.0
+            elif sqrt_price:
+                # Quoter thất bại: dùng giá spot
+                values[position_id] = amount * self._usdc_per_weth_raw(sqrt_price) / 10 ** USDC_DECIMALS
+
+        missing = [p["position_id"] for p in positions if p["position_id"] not in values]
+        if missing:
+            logger.error(f"Could not value positions {missing} at block {block}")
+        return values
@@ -9,6 +9,7 @@ import { ERC20_ABI } from "~~/components/abis/ERC20";
 import { ethers } from "ethers";
 
 const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || "http://localhost:8000/ai_credit_endpoint";
+const EVENTS_URL = process.env.NEXT_PUBLIC_EVENTS_URL || "http://localhost:8000/events";
 const USDC_ADDRESS = process.env.NEXT_PUBLIC_USDC_ADDRESS || "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913"; // Base USDC
 const STRIPE_PUBLISHABLE_KEY = process.env.NEXT_PUBLIC_STRIPE_PUBLISHABLE_KEY || "pk_test_your_key";
 const stripePromise = loadStripe(STRIPE_PUBLISHABLE_KEY);
@@ -131,6 +132,33 @@ export const AIAgentConsole = () => {
     }
   }, [address]);
 
+  // Nhận cập nhật credits, trạng thái giao dịch và giá trị vị thế từ backend (SSE)
+  useEffect(() => {
+    if (!address) return;
+    const source = new EventSource(`${EVENTS_URL}/${address}`);
+    source.addEventListener("credits", (e: MessageEvent) => {
+      setCredits(JSON.parse(e.data).data.credits_remaining);
+    });
+    source.addEventListener("user_op", (e: MessageEvent) => {
+      const { status, user_op_hash, tx_hash, error } = JSON.parse(e.data).data;
+      setOutput(prev => [...prev, `UserOperation ${status}: ${tx_hash || user_op_hash || error || ""}`]);
+    });
+    source.addEventListener("position_value", (e: MessageEvent) => {
+      const { position_id, platform, current_value_usd, profit_ratio } = JSON.parse(e.data).data;
+      setOutput(prev => [...prev, `Position ${position_id} (${platform}): $${current_value_usd.toFixed(2)} (ratio ${profit_ratio.toFixed(4)})`]);
+    });
+    source.addEventListener("withdrawal", (e: MessageEvent) => {
+      const { position_id, platform, user_op_hash } = JSON.parse(e.data).data;
+      setOutput(prev => [...prev, `Auto-withdrawn ${platform} position ${position_id}: ${user_op_hash}`]);
+    });
+    source.addEventListener("job", (e: MessageEvent) => {
+      const { job_id, action, status, user_op_hashes, error } = JSON.parse(e.data).data;
+      const detail = status === "done" ? (user_op_hashes || []).join(", ") : error || "";
+      setOutput(prev => [...prev, `Job ${job_id} (${action}) ${status}: ${detail}`]);
+    });
+    return () => source.close();
+  }, [address]);
+
   const resetState = () => {
     setAaWalletAddress(null);
     setAaWalletBytecode(null);
@@ -217,7 +245,7 @@ export const AIAgentConsole = () => {
             [action === "swap" ? "amount_in" : "amount"]: amount,
             action
           });
-          setOutput([...output, `> ${command}`, `${action} Tx Hash: ${response.data.tx_hash}`]);
+          setOutput([...output, `> ${command}`, `${action} queued as job ${response.data.job_id} (${response.data.status})`]);
           break;
         }
         case "fund": {
@@ -228,7 +256,7 @@ export const AIAgentConsole = () => {
             amount_eth: amount,
             action: "fund_ai_wallet"
           });
-          setOutput([...output, `> ${command}`, `Funded AI Wallet Tx Hash: ${response.data.tx_hash}`]);
+          setOutput([...output, `> ${command}`, `Fund AI Wallet queued as job ${response.data.job_id} (${response.data.status})`]);
           break;
         }
         case "transfer": {
@@ -265,10 +293,16 @@ export const AIAgentConsole = () => {
           if (response.data.status === "no_active_positions") {
             setOutput([...output, `> ${command}`, "No active positions found."]);
           } else {
+            // Vị thế sweep chưa định giá có current_value_usd/profit_ratio là null
             const positions = response.data.positions.map((pos: any) => 
-              `Position ${pos.position_id} (${pos.platform}): Initial: ${pos.initial_value_usd} USD, Current: ${pos.current_value_usd.toFixed(2)} USD, Profit: ${(pos.profit_ratio * 100 - 100).toFixed(2)}%, Action: ${pos.action_taken || "None"}`
+              pos.current_value_usd == null || pos.profit_ratio == null
+                ? `Position ${pos.position_id} (${pos.platform}): Initial: ${pos.initial_value_usd} USD, Current: pending valuation`
+                : `Position ${pos.position_id} (${pos.platform}): Initial: ${pos.initial_value_usd} USD, Current: ${pos.current_value_usd.toFixed(2)} USD, Profit: ${(pos.profit_ratio * 100 - 100).toFixed(2)}%, Action: ${pos.action_taken || "None"}`
             );
-            setOutput([...output, `> ${command}`, ...positions]);
+            const notes = response.data.stale
+              ? ["Some positions have not been valued yet; a refresh has been queued and updates will arrive shortly."]
+              : [];
+            setOutput([...output, `> ${command}`, ...positions, ...notes]);
           }
           break;
         }
@@ -301,8 +335,8 @@ export const AIAgentConsole = () => {
         amount_eth: amount,
         action: "fund_ai_wallet"
       });
-      setOutput([...output, `Funded AI Wallet with ${amount} ETH - Tx Hash: ${response.data.tx_hash}`]);
-      notification.success(`Funded AI Wallet with ${amount} ETH!`);
+      setOutput([...output, `Funding AI Wallet with ${amount} ETH queued as job ${response.data.job_id} (${response.data.status})`]);
+      notification.success(`Queued funding of AI Wallet with ${amount} ETH!`);
     } catch (error: any) {
       handleError(error, "Failed to fund AI Wallet");
     } finally {